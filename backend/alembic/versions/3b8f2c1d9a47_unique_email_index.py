@@ -0,0 +1,45 @@
+"""unique email index
+
+Revision ID: 3b8f2c1d9a47
+Revises: e4423b653a81
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8f2c1d9a47'
+down_revision = 'e4423b653a81'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # a failed concurrent build leaves the users table with an INVALID index, so duplicates are
+    # looked for first; they have to be merged by hand, since users may already have friends
+    duplicates = op.get_bind().execute(sa.text(
+        "SELECT lower(email) FROM users GROUP BY lower(email) HAVING count(*) > 1 LIMIT 10"
+    )).scalars().all()
+    if duplicates:
+        raise RuntimeError(
+            "Cannot create a unique index on lower(email), these emails are registered more than once "
+            f"in different case (showing up to 10): {', '.join(duplicates)}"
+        )
+    # built concurrently, so that the users table stays writable while the index is built
+    with op.get_context().autocommit_block():
+        # left over from an interrupted build
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_email_lower")
+        op.create_index(
+            "ix_users_email_lower",
+            "users",
+            [sa.text("lower(email)")],
+            unique=True,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_users_email_lower", table_name="users", postgresql_concurrently=True)
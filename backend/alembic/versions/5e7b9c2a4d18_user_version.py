@@ -0,0 +1,25 @@
+"""user version
+
+Revision ID: 5e7b9c2a4d18
+Revises: 9d1e7a5c3f20
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7b9c2a4d18'
+down_revision = '9d1e7a5c3f20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # a constant default is stored in the catalog, existing rows are not rewritten
+    op.add_column("users", sa.Column("version", sa.Integer, nullable=False, server_default="1"))
+
+
+def downgrade() -> None:
+    op.drop_column("users", "version")
@@ -0,0 +1,49 @@
+"""canonical friendship
+
+Revision ID: 7a3d5f1b8e62
+Revises: 5e7b9c2a4d18
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a3d5f1b8e62'
+down_revision = '5e7b9c2a4d18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("DELETE FROM friendship WHERE friend_id_one = friend_id_two")
+    # (b, a) goes away when (a, b) is stored too, the remaining ones are swapped
+    op.execute("""
+        DELETE FROM friendship f
+        WHERE f.friend_id_one > f.friend_id_two AND EXISTS (
+            SELECT 1 FROM friendship g WHERE g.friend_id_one = f.friend_id_two AND g.friend_id_two = f.friend_id_one
+        )
+    """)
+    op.execute("""
+        UPDATE friendship SET friend_id_one = friend_id_two, friend_id_two = friend_id_one
+        WHERE friend_id_one > friend_id_two
+    """)
+    op.create_check_constraint("ck_friendship_canonical", "friendship", "friend_id_one < friend_id_two")
+
+    op.add_column("users", sa.Column("friend_count", sa.Integer, nullable=False, server_default="0"))
+    # the profile of these users changes, so does their ETag
+    op.execute("""
+        UPDATE users SET friend_count = counts.friend_count, version = version + 1
+        FROM (
+            SELECT id, count(*) AS friend_count FROM (
+                SELECT friend_id_one AS id FROM friendship UNION ALL SELECT friend_id_two FROM friendship
+            ) AS ends GROUP BY id
+        ) AS counts
+        WHERE users.id = counts.id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column("users", "friend_count")
+    op.drop_constraint("ck_friendship_canonical", "friendship")
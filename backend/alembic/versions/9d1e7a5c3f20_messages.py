@@ -0,0 +1,33 @@
+"""messages
+
+Revision ID: 9d1e7a5c3f20
+Revises: 3b8f2c1d9a47
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d1e7a5c3f20'
+down_revision = '3b8f2c1d9a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "messages",
+        sa.Column("id", sa.BigInteger, sa.Identity(), primary_key=True),
+        sa.Column("room", sa.String, nullable=False),
+        sa.Column("sender_id", sa.UUID, sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("text", sa.String, nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+    )
+    op.create_index("ix_messages_room_created_at", "messages", ["room", "created_at", "id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_room_created_at", table_name="messages")
+    op.drop_table("messages")
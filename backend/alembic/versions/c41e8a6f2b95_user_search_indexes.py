@@ -0,0 +1,52 @@
+"""user search indexes
+
+Revision ID: c41e8a6f2b95
+Revises: 7a3d5f1b8e62
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e8a6f2b95'
+down_revision = '7a3d5f1b8e62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # built concurrently, so that the users table stays writable while the indexes are built
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_name_trgm",
+            "users",
+            ["name"],
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_users_description_trgm",
+            "users",
+            ["description"],
+            postgresql_using="gin",
+            postgresql_ops={"description": "gin_trgm_ops"},
+            postgresql_concurrently=True,
+        )
+        # LIKE 'prefix%' can only use an index in the C collation, it is also the order of suggestions
+        op.create_index(
+            "ix_users_name_prefix",
+            "users",
+            [sa.text('lower(name) COLLATE "C"'), "id"],
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_users_name_prefix", table_name="users", postgresql_concurrently=True)
+        op.drop_index("ix_users_description_trgm", table_name="users", postgresql_concurrently=True)
+        op.drop_index("ix_users_name_trgm", table_name="users", postgresql_concurrently=True)
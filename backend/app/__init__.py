@@ -0,0 +1,4 @@
+import time
+
+# app.main reports the time since then as the import time of the app
+IMPORT_STARTED_AT = time.perf_counter()
@@ -0,0 +1,167 @@
+import csv
+import json
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+from uuid import UUID
+
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud, schemas
+from app.hashing import PasswordHasher
+
+MAX_LINE_BYTES = 64 * 1024
+
+FriendshipsCreated = Callable[[List[Tuple[UUID, UUID]]], Awaitable[None]]
+
+
+class BulkImportError(Exception):
+    pass
+
+
+async def iter_lines(body: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, str]]:
+    """Splits a streamed request body into numbered non-empty lines"""
+    buffer = b""
+    line_no = 0
+    async for data in body:
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        if len(buffer) > MAX_LINE_BYTES:
+            raise BulkImportError(f"Line {line_no + len(lines) + 1} is longer than {MAX_LINE_BYTES} bytes")
+        for line in lines:
+            line_no += 1
+            if line.strip():
+                yield line_no, line.decode(errors="replace")
+    if buffer.strip():
+        yield line_no + 1, buffer.decode(errors="replace")
+
+
+async def iter_rows(body: AsyncIterator[bytes], format: str) -> AsyncIterator[Tuple[int, Dict]]:
+    """Yields (line number, row) pairs, rows that can not be parsed are yielded as exceptions"""
+    header = None
+    async for line_no, line in iter_lines(body):
+        if format == "csv":
+            # one record per line, quoted values with line breaks are not supported
+            values = next(csv.reader([line]))
+            if header is None:
+                header = values
+                continue
+            if len(values) != len(header):
+                yield line_no, ValueError(f"expected {len(header)} values, got {len(values)}")
+                continue
+            yield line_no, dict(zip(header, values))
+        else:
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_no, e
+                continue
+            if not isinstance(row, dict):
+                yield line_no, ValueError("expected a JSON object")
+                continue
+            yield line_no, row
+
+
+async def import_users(db: AsyncSession, body: AsyncIterator[bytes], format: str, hasher: PasswordHasher,
+                       chunk_size: int, max_errors: int) -> schemas.BulkImportReport:
+    """Validates users row by row and writes them by chunks, so memory does not depend on the body size"""
+    report = schemas.BulkImportReport()
+    chunk: List[Tuple[int, schemas.User]] = []
+    async for line_no, row in iter_rows(body, format):
+        if isinstance(row, Exception):
+            report.add_error(line_no, str(row), max_errors)
+            continue
+        try:
+            chunk.append((line_no, schemas.User(**row)))
+        except ValidationError as e:
+            report.add_error(line_no, str(e), max_errors)
+            continue
+        if len(chunk) >= chunk_size:
+            await _write_chunk(db, chunk, hasher, report, max_errors)
+            chunk = []
+    if chunk:
+        await _write_chunk(db, chunk, hasher, report, max_errors)
+    return report
+
+
+async def _write_chunk(db: AsyncSession, chunk: List[Tuple[int, schemas.User]], hasher: PasswordHasher,
+                       report: schemas.BulkImportReport, max_errors: int):
+    chunk = _skip_repeated(chunk, report, max_errors)
+    passwords = await hasher.hash_many([user.password for _, user in chunk])
+    for (_, user), password in zip(chunk, passwords):
+        user.password = password
+    inserted = await crud.copy_users(db, [user for _, user in chunk])
+    report.inserted += len(inserted)
+    for line_no, user in chunk:
+        if user.id not in inserted:
+            report.add_error(line_no, "Email or id already registered", max_errors)
+
+
+def _skip_repeated(chunk: List[Tuple[int, schemas.User]], report: schemas.BulkImportReport,
+                   max_errors: int) -> List[Tuple[int, schemas.User]]:
+    """Reports rows that repeat the id or email of an earlier row of the chunk.
+
+    COPY would insert the first of them and return its id for all of them.
+    """
+    id_lines: Dict[UUID, int] = {}
+    email_lines: Dict[str, int] = {}
+    unique = []
+    for line_no, user in chunk:
+        email = user.email.lower()
+        if user.id in id_lines:
+            report.add_error(line_no, f"Id repeats line {id_lines[user.id]}", max_errors)
+        elif email in email_lines:
+            report.add_error(line_no, f"Email repeats line {email_lines[email]}", max_errors)
+        else:
+            id_lines[user.id] = email_lines[email] = line_no
+            unique.append((line_no, user))
+    return unique
+
+
+async def import_friendships(db: AsyncSession, body: AsyncIterator[bytes], created: FriendshipsCreated,
+                             chunk_size: int, max_errors: int) -> schemas.FriendshipImportReport:
+    """Imports NDJSON pairs {"id_friend_one": ..., "id_friend_two": ...} by chunks.
+
+    `created` is awaited with the pairs inserted by every chunk.
+    """
+    report = schemas.FriendshipImportReport()
+    chunk: Dict[Tuple[UUID, UUID], int] = {}
+    async for line_no, row in iter_rows(body, "ndjson"):
+        if isinstance(row, Exception):
+            report.add_error(line_no, str(row), max_errors)
+            continue
+        try:
+            # parsed by hand, a pydantic model per row would dominate the import time
+            one, two = UUID(row["id_friend_one"]), UUID(row["id_friend_two"])
+        except KeyError as e:
+            report.add_error(line_no, f"{e.args[0]} is missing", max_errors)
+            continue
+        except (TypeError, ValueError, AttributeError) as e:
+            report.add_error(line_no, f"invalid id: {e}", max_errors)
+            continue
+        if one == two:
+            report.add_error(line_no, "User can not befriend themselves", max_errors)
+            continue
+        pair = crud.canonical_pair(one, two)
+        if pair in chunk:
+            report.duplicates += 1
+            continue
+        chunk[pair] = line_no
+        if len(chunk) >= chunk_size:
+            await _write_friendships(db, list(chunk), created, report)
+            chunk = {}
+    if chunk:
+        await _write_friendships(db, list(chunk), created, report)
+    return report
+
+
+async def _write_friendships(db: AsyncSession, pairs: List[Tuple[UUID, UUID]], created: FriendshipsCreated,
+                             report: schemas.FriendshipImportReport):
+    existing = await crud.get_existing_user_ids(db, list({user_id for pair in pairs for user_id in pair}))
+    known = [pair for pair in pairs if pair[0] in existing and pair[1] in existing]
+    report.missing += len(pairs) - len(known)
+    if not known:
+        return
+    inserted = await crud.copy_friendships(db, known)
+    report.inserted += len(inserted)
+    report.duplicates += len(known) - len(inserted)
+    await created(inserted)
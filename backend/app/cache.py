@@ -0,0 +1,47 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from prometheus_client import Counter
+
+CACHE_HITS = Counter("cache_hits_total", "Lookups answered from an in-process cache", ["cache"])
+CACHE_MISSES = Counter("cache_misses_total", "Lookups not found in an in-process cache", ["cache"])
+CACHE_EVICTIONS = Counter("cache_evictions_total", "Entries evicted from an in-process cache", ["cache"])
+
+
+class TTLCache:
+    """LRU cache with a fixed size whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._items.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at > time.monotonic():
+                self._items.move_to_end(key)
+                CACHE_HITS.labels(self.name).inc()
+                return value
+            del self._items[key]
+        CACHE_MISSES.labels(self.name).inc()
+        return None
+
+    def set(self, key: Hashable, value: Any):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+            CACHE_EVICTIONS.labels(self.name).inc()
+
+    def invalidate(self, key: Hashable):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
@@ -1,22 +1,117 @@
-from typing import List
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set
+from uuid import UUID
 
+from prometheus_client import Counter, Gauge
+from starlette import status
 from starlette.websockets import WebSocket
 
+logger = logging.getLogger(__name__)
+
+CHAT_CONNECTIONS = Gauge("chat_connections", "Connected chat websockets", multiprocess_mode="livesum")
+CHAT_DROPPED_MESSAGES = Counter(
+    "chat_dropped_messages_total", "Messages dropped because a client did not read them in time"
+)
+CHAT_SLOW_CONSUMERS = Counter(
+    "chat_slow_consumers_disconnected_total", "Clients disconnected because they did not read messages in time"
+)
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+
+def friends_room(user_id: UUID, friend_id: UUID) -> str:
+    return "friends:" + ":".join(sorted((str(user_id), str(friend_id))))
+
+
+class Connection:
+    """Websocket with its own outbound queue, written by a separate task.
+
+    Messages are queued without waiting, so a slow client never delays the others.
+    """
+
+    def __init__(self, websocket: WebSocket, room: str, queue_size: int):
+        self.websocket = websocket
+        self.room = room
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write())
+
+    async def _write(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                await self.websocket.send_text(message)
+        except Exception:
+            logger.debug("Websocket of room %s is closed", self.room, exc_info=True)
+
+    def send(self, message: str, policy: str) -> bool:
+        """Queues a message, returns False if the queue is full and the client should be dropped"""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            if policy != DROP_OLDEST:
+                return False
+            self.queue.get_nowait()
+            self.queue.put_nowait(message)
+            CHAT_DROPPED_MESSAGES.inc()
+        return True
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    """Process-wide registry of chat rooms.
 
-    async def connect(self, websocket: WebSocket):
+    `policy` decides what happens to a client whose queue is full: DROP_OLDEST trims
+    its oldest queued message, DISCONNECT closes its websocket.
+    """
+
+    def __init__(self, queue_size: int = 100, policy: str = DROP_OLDEST):
+        self.queue_size = queue_size
+        self.policy = policy
+        self.rooms: Dict[str, Set[Connection]] = {}
+        # the event loop keeps only weak references to tasks
+        self._drops: Set[asyncio.Task] = set()
+
+    async def connect(self, websocket: WebSocket, room: str) -> Connection:
         await websocket.accept()
-        self.active_connections.append(websocket)
+        return self.join(websocket, room)
+
+    def join(self, websocket: WebSocket, room: str) -> Connection:
+        """Adds a websocket that is accepted already to the room"""
+        connection = Connection(websocket, room, self.queue_size)
+        connection.start()
+        connection.writer.add_done_callback(lambda _: self.disconnect(connection))
+        self.rooms.setdefault(room, set()).add(connection)
+        CHAT_CONNECTIONS.inc()
+        return connection
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def disconnect(self, connection: Connection):
+        connections = self.rooms.get(connection.room)
+        if connections is None or connection not in connections:
+            return
+        connections.remove(connection)
+        if not connections:
+            del self.rooms[connection.room]
+        connection.writer.cancel()
+        CHAT_CONNECTIONS.dec()
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+    async def _drop(self, connection: Connection):
+        self.disconnect(connection)
+        CHAT_SLOW_CONSUMERS.inc()
+        try:
+            await connection.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except Exception:
+            logger.debug("Websocket of a slow client is already closed", exc_info=True)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+    def broadcast(self, room: str, message: str):
+        slow: List[Connection] = []
+        for connection in self.rooms.get(room, ()):
+            if not connection.send(message, self.policy):
+                slow.append(connection)
+        for connection in slow:
+            task = asyncio.create_task(self._drop(connection))
+            self._drops.add(task)
+            task.add_done_callback(self._drops.discard)
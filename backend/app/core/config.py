@@ -1,4 +1,4 @@
-from typing import List, Union
+from typing import Dict, List, Literal, Optional, Union
 
 from pydantic import AnyHttpUrl, BaseSettings, validator
 
@@ -7,6 +7,91 @@ class Settings(BaseSettings):
     PROJECT_NAME: str
     BACKEND_CORS_ORIGINS: List[AnyHttpUrl] = []
 
+    DATABASE_URL: str = "postgresql+asyncpg://admin:pwd@db:5432/postgres"
+    # read-only endpoints are spread over these, as a JSON list
+    DATABASE_REPLICA_URLS: List[str] = []
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    # a round trip on every checkout of the primary, only worth it where idle connections get cut, pool_recycle
+    # covers the rest, replicas are always pinged so that reads can fall back to the primary
+    DB_POOL_PRE_PING: bool = False
+    DB_STATEMENT_CACHE_SIZE: int = 500
+
+    PASSWORD_HASH_EXECUTOR: Literal["thread", "process"] = "thread"
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_MAX_QUEUE: int = 64
+    PASSWORD_HASH_FAIL_FAST: bool = False
+
+    PRINCIPAL_CACHE_SIZE: int = 10_000
+    PRINCIPAL_CACHE_TTL: float = 60.0
+
+    LOGIN_DATE_FLUSH_INTERVAL: float = 1.0
+    LOGIN_DATE_FLUSH_SIZE: int = 1000
+
+    FRIEND_GRAPH_ENABLED: bool = True
+    FRIEND_GRAPH_MAX_USERS: int = 2_500_000
+    FRIEND_GRAPH_MAX_FRIENDSHIPS: int = 8_000_000
+    FRIEND_GRAPH_LOAD_CHUNK: int = 50_000
+    # friendships added after the load are merged into the loaded arrays once there are this many
+    FRIEND_GRAPH_COMPACT_AFTER: int = 100_000
+
+    USERS_BATCH_MAX_IDS: int = 1000
+    BULK_IMPORT_CHUNK_SIZE: int = 1000
+    BULK_IMPORT_MAX_ERRORS: int = 1000
+    # friendships are cheap to write, larger chunks mean fewer round trips
+    BULK_FRIENDSHIP_CHUNK_SIZE: int = 50_000
+    # rows fetched from the server-side cursor at once by GET /users/export
+    EXPORT_CHUNK_SIZE: int = 10_000
+
+    CHAT_QUEUE_SIZE: int = 100
+    CHAT_SLOW_CONSUMER_POLICY: Literal["drop_oldest", "disconnect"] = "drop_oldest"
+    # "postgres" is needed to run more than one worker, "memory" delivers within the process only
+    CHAT_PUBSUB_BACKEND: Literal["memory", "postgres"] = "memory"
+    CHAT_HISTORY_FLUSH_INTERVAL: float = 0.2
+    CHAT_HISTORY_FLUSH_SIZE: int = 500
+    CHAT_HISTORY_MAX_PENDING: int = 50_000
+    # seconds a friends chat page has to open its websocket, it sends the ticket as the first message
+    CHAT_TICKET_TTL: int = 60
+
+    PROFILER_ENABLED: bool = False
+    PROFILER_SAMPLE_RATE: float = 0.01
+    # sampled requests faster than this are discarded, seconds
+    PROFILER_THRESHOLD: float = 0.5
+    PROFILER_INTERVAL: float = 0.005
+    PROFILER_MAX_STACKS: int = 10_000
+    # the x-profile header with it forces profiling, /admin/profile needs it in x-admin-token
+    PROFILER_TOKEN: Optional[str] = None
+
+    # off by default: behind a proxy every client has the proxy's address, unless RATE_LIMIT_TRUST_FORWARDED
+    # is on, and one bucket for everybody would reject most requests, load tests included
+    RATE_LIMIT_ENABLED: bool = False
+    # "redis" shares buckets between workers and replicas
+    RATE_LIMIT_BACKEND: Literal["memory", "redis"] = "memory"
+    RATE_LIMIT_REDIS_URL: str = "redis://redis:6379/0"
+    # tokens a second and bucket size of every client, 0 disables the limit
+    RATE_LIMIT_CLIENT_RATE: float = 50
+    RATE_LIMIT_CLIENT_BURST: float = 500
+    # tokens a request of the route costs, 1 when not listed, 0 exempts it; bcrypt makes these expensive
+    RATE_LIMIT_WEIGHTS: Dict[str, float] = {
+        "POST /users/login": 5,
+        "POST /users/": 5,
+        "POST /users/bulk": 20,
+        "POST /users/friends/bulk": 20,
+        "GET /users/export": 20,
+        "GET /metrics": 0,
+    }
+    # requests a second of the route across all clients, as a JSON object
+    RATE_LIMIT_ROUTE_RATES: Dict[str, float] = {}
+    # requests handled at once by the worker before the rest get 503, 0 disables the limit
+    RATE_LIMIT_MAX_CONCURRENCY: int = 512
+    # key clients by the first X-Forwarded-For address, only behind a proxy that sets it
+    RATE_LIMIT_TRUST_FORWARDED: bool = False
+
+    # how often every worker reports its CPU and memory usage, seconds
+    PROCESS_METRICS_INTERVAL: float = 5.0
+
     @validator("BACKEND_CORS_ORIGINS", pre=True)
     def assemble_cors_origins(cls, v: Union[str, List[str]]) -> Union[List[str], str]:
         if isinstance(v, str) and not v.startswith("["):
@@ -1,68 +1,290 @@
 import datetime
+from typing import Dict, List, Optional, Set, Tuple
 from uuid import UUID
-from sqlalchemy import select, update
+from sqlalchemy import DateTime, Float, String, and_, any_, bindparam, cast, collate, column, func, \
+    insert as sql_insert, literal, or_, select, text, tuple_, union_all, update, values
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from . import models, schemas
 
+PUBLIC_USER_COLUMNS = (
+    models.User.id,
+    models.User.name,
+    models.User.description,
+    models.User.age,
+    models.User.email,
+    models.User.login_date,
+)
+
+
+def email_matches(email: str):
+    return func.lower(models.User.email) == func.lower(email)
+
 
 async def get_user(db: AsyncSession, user_id: UUID):
     return await db.execute(select(models.User).where(models.User.id == user_id))
 
 
+async def get_public_user(db: AsyncSession, user_id: UUID):
+    return await db.execute(select(*PUBLIC_USER_COLUMNS, models.User.friend_count, models.User.version)
+                            .where(models.User.id == user_id))
+
+
+async def get_user_version(db: AsyncSession, user_id: UUID):
+    return await db.execute(select(models.User.version).where(models.User.id == user_id))
+
+
 async def get_user_by_email(db: AsyncSession, email: str):
-    return await db.execute(select(models.User).where(models.User.email == email))
+    return await db.execute(select(models.User).where(email_matches(email)))
+
+
+async def get_user_credentials(db: AsyncSession, email: str):
+    return await db.execute(select(*PUBLIC_USER_COLUMNS, models.User.password).where(email_matches(email)))
+
+
+async def get_users(db: AsyncSession, after: Optional[UUID] = None, limit: int = 100):
+    query = select(*PUBLIC_USER_COLUMNS).order_by(models.User.id).limit(limit)
+    if after is not None:
+        query = query.where(models.User.id > after)
+    return await db.execute(query)
+
+
+async def stream_users(db: AsyncSession, login_from: Optional[datetime.datetime] = None,
+                       login_until: Optional[datetime.datetime] = None, chunk_size: int = 10_000):
+    """Users through a server-side cursor, fetched `chunk_size` rows at a time"""
+    query = select(*PUBLIC_USER_COLUMNS)
+    if login_from is not None:
+        query = query.where(models.User.login_date >= login_from)
+    if login_until is not None:
+        query = query.where(models.User.login_date < login_until)
+    return await db.stream(query.execution_options(yield_per=chunk_size))
+
 
+# below 1, so that users matching by name rank above those matching only by description
+SEARCH_DESCRIPTION_WEIGHT = 0.5
 
-async def get_user_password(db: AsyncSession, email: str):
-    return await db.execute(select(models.User.password).where(models.User.email == email))
 
+def search_score(query: str):
+    """How well the query matches a word sequence of the name or the description, from 0 to 1"""
+    query = literal(query, String)
+    return cast(func.greatest(
+        func.word_similarity(query, models.User.name),
+        SEARCH_DESCRIPTION_WEIGHT * func.word_similarity(query, models.User.description),
+    ), Float)
 
-async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100):
-    return await db.execute(select(models.User).limit(limit))
+
+def search_users_query(query: str, after: Optional[Tuple[float, UUID]] = None, limit: int = 20):
+    score = search_score(query)
+    # <% is answered by the trigram indexes, it keeps word_similarity above pg_trgm.word_similarity_threshold
+    statement = select(*PUBLIC_USER_COLUMNS, score.label("score")).where(or_(
+        literal(query, String).op("<%")(models.User.name),
+        literal(query, String).op("<%")(models.User.description),
+    ))
+    if after is not None:
+        after_score, after_id = after
+        statement = statement.where(or_(score < after_score, and_(score == after_score, models.User.id > after_id)))
+    return statement.order_by(score.desc(), models.User.id).limit(limit)
+
+
+async def search_users(db: AsyncSession, query: str, after: Optional[Tuple[float, UUID]] = None, limit: int = 20):
+    return await db.execute(search_users_query(query, after, limit))
+
+
+def autocomplete_query(prefix: str, limit: int = 10):
+    name = collate(func.lower(models.User.name), "C")
+    return select(*PUBLIC_USER_COLUMNS).where(name.startswith(prefix.lower(), autoescape=True)) \
+        .order_by(name, models.User.id).limit(limit)
+
+
+async def autocomplete_users(db: AsyncSession, prefix: str, limit: int = 10):
+    return await db.execute(autocomplete_query(prefix, limit))
 
 
 async def create_user(db: AsyncSession, user: schemas.User):
-    db_item = models.User(id=user.id, name=user.name, description=user.description, age=user.age, email=user.email,
-                          password=user.password)
-    db.add(db_item)
+    """Returns id of the new user or None if the email is already registered.
+
+    A taken id raises IntegrityError.
+    """
+    user_id = await db.execute(insert(models.User).values(
+        id=user.id, name=user.name, description=user.description, age=user.age, email=user.email,
+        password=user.password
+    ).on_conflict_do_nothing(index_elements=[func.lower(models.User.email)]).returning(models.User.id))
+    user_id = user_id.scalar_one_or_none()
+    await db.commit()
+    return user_id
+
+
+USER_COPY_COLUMNS = ("id", "name", "description", "age", "email", "password", "login_date")
+
+
+async def copy_users(db: AsyncSession, users: List[schemas.User]) -> Set[UUID]:
+    """Writes users with COPY through a staging table, returns ids of the inserted ones.
+
+    Users whose email or id is already registered are skipped.
+    """
+    columns = ", ".join(USER_COPY_COLUMNS)
+    await db.execute(text(
+        "CREATE TEMP TABLE IF NOT EXISTS users_import (LIKE users INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+    ))
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        "users_import",
+        records=[(user.id, user.name, user.description, user.age, user.email, user.password, user.login_date)
+                 for user in users],
+        columns=USER_COPY_COLUMNS,
+    )
+    inserted = await db.execute(text(
+        f"INSERT INTO users ({columns}) SELECT {columns} FROM users_import ON CONFLICT DO NOTHING RETURNING id"
+    ))
+    inserted = set(inserted.scalars())
     await db.commit()
-    await db.refresh(db_item)
-    return db_item.id
+    return inserted
 
 
 async def update_user(db: AsyncSession, user_id: UUID, user: schemas.User):
     await db.execute(update(models.User).where(models.User.id == user_id).values({
         "name": user.name, "description": user.description, "email": user.email, "age": user.age,
-        "password": user.password
+        "password": user.password, "version": models.User.version + 1
     }))
     await db.commit()
     return user
 
 
-async def create_friendship(db: AsyncSession, friends: schemas.Friends):
-    db_item = models.Friendship(friend_id_one=friends.id_friend_one, friend_id_two=friends.id_friend_two)
-    db.add(db_item)
+def canonical_pair(user_id: UUID, friend_id: UUID) -> Tuple[UUID, UUID]:
+    """Friendship key of two users, the smaller id first like Postgres orders uuids"""
+    return (user_id, friend_id) if user_id < friend_id else (friend_id, user_id)
+
+
+async def create_friendship(db: AsyncSession, friends: schemas.Friends) -> bool:
+    """Returns False if the users are already friends"""
+    one, two = canonical_pair(friends.id_friend_one, friends.id_friend_two)
+    inserted = await db.execute(insert(models.Friendship).values(friend_id_one=one, friend_id_two=two)
+                                .on_conflict_do_nothing().returning(models.Friendship.friend_id_one))
+    inserted = inserted.first() is not None
+    if inserted:
+        await db.execute(update(models.User).where(models.User.id.in_([one, two])).values({
+            "friend_count": models.User.friend_count + 1, "version": models.User.version + 1
+        }))
     await db.commit()
-    await db.refresh(db_item)
-    return db_item
+    return inserted
+
+
+async def copy_friendships(db: AsyncSession, friendships: List[Tuple[UUID, UUID]]) -> List[Tuple[UUID, UUID]]:
+    """Writes canonical pairs with COPY through a staging table, returns the inserted ones.
+
+    Pairs already stored are skipped, friend counts of the users are updated in the same transaction.
+    """
+    await db.execute(text(
+        "CREATE TEMP TABLE IF NOT EXISTS friendship_import (LIKE friendship) ON COMMIT DELETE ROWS"
+    ))
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        "friendship_import", records=friendships, columns=("friend_id_one", "friend_id_two")
+    )
+    inserted = await db.execute(text("""
+        WITH inserted AS (
+            INSERT INTO friendship (friend_id_one, friend_id_two)
+            SELECT friend_id_one, friend_id_two FROM friendship_import
+            ON CONFLICT DO NOTHING
+            RETURNING friend_id_one, friend_id_two
+        ), counted AS (
+            UPDATE users SET friend_count = users.friend_count + ends.added, version = users.version + 1
+            FROM (
+                SELECT id, count(*) AS added FROM (
+                    SELECT friend_id_one AS id FROM inserted UNION ALL SELECT friend_id_two FROM inserted
+                ) AS ids GROUP BY id
+            ) AS ends
+            WHERE users.id = ends.id
+        )
+        SELECT friend_id_one, friend_id_two FROM inserted
+    """))
+    inserted = [tuple(row) for row in inserted]
+    await db.commit()
+    return inserted
+
+
+def friendship_query(friend_id: UUID, user_id: UUID):
+    one, two = canonical_pair(friend_id, user_id)
+    return select(models.Friendship).where(models.Friendship.friend_id_one == one,
+                                           models.Friendship.friend_id_two == two)
 
 
 async def find_friendship(db: AsyncSession, friend_id: UUID, user_id: UUID):
-    return await db.execute(select(models.Friendship).where((
-                                                                    (models.Friendship.friend_id_one == friend_id) & (
-                                                                        models.Friendship.friend_id_two == user_id)) |
-                                                            (models.Friendship.friend_id_one == user_id) & (
-                                                                        models.Friendship.friend_id_two == friend_id)))
+    return await db.execute(friendship_query(friend_id, user_id))
 
 
-async def update_login_date(db: AsyncSession, user_id: UUID):
-    await db.execute(update(models.User).where(models.User.id == user_id).values({
-        "login_date": datetime.datetime.utcnow()
-    }))
+async def update_login_dates(db: AsyncSession, login_dates: Dict[UUID, datetime.datetime], chunk_size: int = 5000):
+    login_dates = list(login_dates.items())
+    for start in range(0, len(login_dates), chunk_size):
+        rows = values(column("id", postgresql.UUID), column("login_date", DateTime(timezone=True)), name="new_login_dates")
+        rows = rows.data(login_dates[start:start + chunk_size])
+        await db.execute(update(models.User).where(models.User.id == rows.c.id).values({
+            "login_date": rows.c.login_date, "version": models.User.version + 1
+        }))
     await db.commit()
 
 
+def friend_ids_query(user_id: UUID):
+    return select(models.Friendship.friend_id_two).where(models.Friendship.friend_id_one == user_id).union(
+        select(models.Friendship.friend_id_one).where(models.Friendship.friend_id_two == user_id))
+
+
+def friend_suggestions_query(user_id: UUID, limit: int):
+    """Friends of friends who are not friends yet, with the most mutual friends first"""
+    friendship = models.Friendship
+    # both directions of every friendship
+    edges = union_all(
+        select(friendship.friend_id_one.label("friend"), friendship.friend_id_two.label("candidate")),
+        select(friendship.friend_id_two.label("friend"), friendship.friend_id_one.label("candidate")),
+    ).subquery()
+    friend_ids = friend_ids_query(user_id)
+    mutual_friends = func.count().label("mutual_friends")
+    return select(edges.c.candidate, mutual_friends).where(
+        edges.c.friend.in_(friend_ids), edges.c.candidate != user_id, edges.c.candidate.not_in(friend_ids)
+    ).group_by(edges.c.candidate).order_by(mutual_friends.desc(), edges.c.candidate).limit(limit)
+
+
+async def get_friend_suggestions(db: AsyncSession, user_id: UUID, limit: int):
+    return await db.execute(friend_suggestions_query(user_id, limit))
+
+
+async def get_friend_ids(db: AsyncSession, user_id: UUID):
+    return await db.execute(friend_ids_query(user_id))
+
+
 async def get_friends(db: AsyncSession, user_id: UUID):
-    return await db.execute(select(models.User).filter(
-        (models.Friendship.friend_id_one == user_id) | (models.Friendship.friend_id_two == user_id)
+    return await db.execute(select(*PUBLIC_USER_COLUMNS).where(
+        models.User.id.in_(friend_ids_query(user_id))
     ).where(models.User.id != user_id).order_by(models.User.id))
+
+
+async def get_users_by_ids(db: AsyncSession, user_ids: List[UUID]):
+    ids = bindparam("ids", list(user_ids), type_=postgresql.ARRAY(postgresql.UUID))
+    return await db.execute(select(*PUBLIC_USER_COLUMNS).where(models.User.id == any_(ids)).order_by(models.User.id))
+
+
+async def get_existing_user_ids(db: AsyncSession, user_ids: List[UUID]) -> Set[UUID]:
+    ids = bindparam("ids", list(user_ids), type_=postgresql.ARRAY(postgresql.UUID))
+    existing = await db.execute(select(models.User.id).where(models.User.id == any_(ids)))
+    return set(existing.scalars())
+
+
+async def create_messages(db: AsyncSession, messages: List[Dict]):
+    await db.execute(sql_insert(models.Message), messages)
+    await db.commit()
+
+
+async def get_messages(db: AsyncSession, room: str, before: Optional[Tuple[datetime.datetime, int]] = None,
+                       limit: int = 50):
+    """Newest messages of the room first, `before` is (created_at, id) of the last message of the previous page"""
+    query = select(models.Message.id, models.Message.sender_id, models.Message.text, models.Message.created_at).where(
+        models.Message.room == room
+    ).order_by(models.Message.created_at.desc(), models.Message.id.desc()).limit(limit)
+    if before is not None:
+        query = query.where(tuple_(models.Message.created_at, models.Message.id) < tuple_(
+            *before, types=[models.Message.created_at.type, models.Message.id.type]
+        ))
+    return await db.execute(query)
@@ -1,14 +1,110 @@
+import itertools
+import logging
+import time
+
+from prometheus_client import Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.core.config import settings
+from app.db_metrics import instrument
+
+logger = logging.getLogger(__name__)
+
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Time a request waits for a database connection", ["engine"]
+)
+# every worker has its own pools, so their connections add up and the busiest pool is the utilization
+POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Database connections in use", ["engine"],
+                         multiprocess_mode="livesum")
+POOL_UTILIZATION = Gauge(
+    "db_pool_utilization", "Database connections in use out of pool size plus overflow", ["engine"],
+    multiprocess_mode="livemax",
+)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Observes how long checkouts wait, the engine's name is the pool's logging_name"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.labels(self.logging_name).observe(time.perf_counter() - start)
+
+
+def track_pool(name: str, _engine: AsyncEngine):
+    """Updates the pool gauges on checkout and checkin, gauges computed at scrape time only work in one process"""
+    pool = _engine.sync_engine.pool
+    capacity = settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW
+
+    def update(checked_out: int):
+        POOL_CHECKED_OUT.labels(name).set(checked_out)
+        POOL_UTILIZATION.labels(name).set(checked_out / capacity)
 
-SQLALCHEMY_DATABASE_URL = "postgresql+asyncpg://admin:pwd@db:5432/postgres"
+    update(0)
+    event.listen(_engine.sync_engine, "checkout", lambda *_: update(pool.checkedout()))
+    # checkin fires before the connection is back in the pool
+    event.listen(_engine.sync_engine, "checkin", lambda *_: update(pool.checkedout() - 1))
 
-engine = create_async_engine(SQLALCHEMY_DATABASE_URL)
+
+def create_engine(name: str, url: str, pre_ping: bool = settings.DB_POOL_PRE_PING) -> AsyncEngine:
+    _engine = create_async_engine(
+        url,
+        poolclass=TimedQueuePool,
+        pool_logging_name=name,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=pre_ping,
+        connect_args={"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE},
+    )
+    track_pool(name, _engine)
+    instrument(_engine)
+    return _engine
+
+
+engine = create_engine("primary", settings.DATABASE_URL)
+# for plain asyncpg connections, e.g. the ones that LISTEN
+ASYNCPG_DSN = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
 async_session = async_sessionmaker(engine, expire_on_commit=False)
 
+# pinged on checkout, a dead pooled connection does not fail until the first query otherwise,
+# when get_read_session can no longer fall back
+replica_engines = [
+    create_engine(f"replica{i}", url, pre_ping=True) for i, url in enumerate(settings.DATABASE_REPLICA_URLS)
+]
+replica_sessions = [async_sessionmaker(replica, expire_on_commit=False) for replica in replica_engines]
+_replica_turn = itertools.count()
+
 
 async def get_session() -> AsyncSession:
+    """Session on the primary, which checks out a connection on its first query"""
+    async with async_session() as session:
+        yield session
+
+
+async def get_read_session() -> AsyncSession:
+    """Session on one of the replicas in turn, or on the primary if there are none or they are down.
+
+    Replicas may lag behind, use it only where a slightly stale read is fine. A replica's
+    connection is checked out and pinged up front, to fall back while the handler has not run yet.
+    """
+    for _ in replica_sessions:
+        turn = next(_replica_turn) % len(replica_sessions)
+        async with replica_sessions[turn]() as session:
+            try:
+                await session.connection()
+            except (OSError, SQLAlchemyError):
+                logger.warning("Replica %d is unavailable", turn, exc_info=True)
+                continue
+            yield session
+            return
     async with async_session() as session:
         yield session
 
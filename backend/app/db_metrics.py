@@ -0,0 +1,95 @@
+import re
+import time
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import List, Optional
+
+from prometheus_client import Histogram
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "Duration of SQL statements by fingerprint",
+    ["statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+QUERY_ROWS = Histogram(
+    "db_query_rows",
+    "Rows returned or affected by SQL statements by fingerprint",
+    ["statement"],
+    buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000),
+)
+QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request",
+    "SQL statements executed while handling one request",
+    ["handler"],
+    buckets=(0, 1, 2, 3, 4, 5, 7, 10, 20, 50, 100),
+)
+
+_queries: ContextVar[Optional[List[int]]] = ContextVar("queries", default=None)
+
+_WHITESPACE = re.compile(r"\s+")
+_LITERALS = re.compile(
+    r"'(?:[^']|'')*'|\$\d+(?:::(?:TIMESTAMP WITH(?:OUT)? TIME ZONE|\w+(?:\[\])?))?|%\(\w+\)s|\b\d+(?:\.\d+)?\b"
+)
+_LISTS = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_VALUES = re.compile(r"VALUES \(\.\.\.\)(?:, \(\.\.\.\))+")
+
+
+@lru_cache(maxsize=2048)
+def fingerprint(statement: str) -> str:
+    """Statement with literals and parameters replaced, so that calls of the same query share a label"""
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    statement = _LITERALS.sub("?", statement)
+    statement = _LISTS.sub("(...)", statement)
+    statement = _VALUES.sub("VALUES (...)", statement)
+    return statement[:200]
+
+
+def instrument(engine: AsyncEngine):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.query_started_at = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        label = fingerprint(statement)
+        QUERY_DURATION.labels(label).observe(time.perf_counter() - context.query_started_at)
+        if cursor.rowcount >= 0:
+            QUERY_ROWS.labels(label).observe(cursor.rowcount)
+        queries = _queries.get()
+        if queries is not None:
+            queries[0] += 1
+
+
+def route_path(scope: Scope) -> str:
+    """Path template of the route handling the request, e.g. /users/{user_id}"""
+    for route in scope["app"].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "none"
+
+
+class QueryCountMiddleware:
+    """Counts SQL statements of every HTTP request, a handler with a growing count has N+1 queries"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        queries = [0]
+        token = _queries.set(queries)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _queries.reset(token)
+            QUERIES_PER_REQUEST.labels(route_path(scope)).observe(queries[0])
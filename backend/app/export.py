@@ -0,0 +1,28 @@
+import csv
+import io
+from typing import AsyncIterator
+
+import orjson
+from sqlalchemy.ext.asyncio import AsyncResult
+
+from app import crud
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+CSV_HEADER = [column.key for column in crud.PUBLIC_USER_COLUMNS]
+
+
+async def export_users(users: AsyncResult, format: str) -> AsyncIterator[bytes]:
+    """Encodes rows one fetched chunk at a time, so memory does not depend on the table size"""
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_HEADER)
+        yield buffer.getvalue().encode()
+        async for partition in users.partitions():
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(partition)
+            yield buffer.getvalue().encode()
+    else:
+        async for partition in users.partitions():
+            yield b"".join(orjson.dumps(row._asdict(), option=orjson.OPT_APPEND_NEWLINE) for row in partition)
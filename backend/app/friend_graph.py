@@ -0,0 +1,263 @@
+import asyncio
+import logging
+from array import array
+from collections import Counter
+from itertools import accumulate
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app import models
+
+logger = logging.getLogger(__name__)
+
+# the build loops give control back to the event loop after this many edges
+YIELD_EVERY = 100_000
+
+
+class GraphNotReady(Exception):
+    pass
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+class FriendGraph:
+    """In-memory adjacency index over the friendship table.
+
+    Users are mapped to dense int nodes on first sight. Edges loaded at startup are
+    kept CSR-style: neighbours of node n are `_targets[_offsets[n]:_offsets[n + 1]]`.
+    Edges added later by add_edge() go to a per-node overlay, which is merged into
+    the CSR arrays in the background once it holds `compact_after` edges.
+
+    Memory per user is ~16 bytes in `_uuids`, ~100 bytes in `_nodes` and 4 bytes in
+    `_offsets`, per friendship 8 bytes in `_targets` (both directions), so 2M users
+    with 6M friendships take about 300 MB. Loading is abandoned with a warning if the
+    table is larger than `max_users` or `max_friendships`, callers then fall back to SQL.
+
+    Every worker process keeps its own index, edges created by other workers arrive
+    through the pub/sub.
+    """
+
+    def __init__(self, max_users: int, max_friendships: int, compact_after: int = 100_000):
+        self.max_users = max_users
+        self.max_friendships = max_friendships
+        self.compact_after = compact_after
+        self._loading = False
+        self._task: Optional[asyncio.Task] = None
+        self._compaction: Optional[asyncio.Task] = None
+        # bumped by every reset, so that a compaction of the previous graph is discarded
+        self._generation = 0
+        self._reset()
+
+    def _reset(self):
+        self.ready = False
+        self._generation += 1
+        self._nodes: Dict[bytes, int] = {}
+        self._uuids = bytearray()
+        self._offsets = array("I", [0])
+        self._targets = array("I")
+        self._overlay: Dict[int, Set[int]] = {}
+        self._overlay_edges = 0
+        self._pending: List[Tuple[UUID, UUID]] = []
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _node(self, user_id: UUID) -> int:
+        key = user_id.bytes
+        node = self._nodes.get(key)
+        if node is None:
+            if len(self._nodes) >= self.max_users:
+                raise MemoryBudgetExceeded(f"more than {self.max_users} users")
+            node = self._nodes[key] = len(self._nodes)
+            self._uuids += key
+        return node
+
+    def _user_id(self, node: int) -> UUID:
+        return UUID(bytes=bytes(self._uuids[node * 16:node * 16 + 16]))
+
+    def _neighbours(self, node: int) -> Set[int]:
+        neighbours = set()
+        if node + 1 < len(self._offsets):
+            neighbours.update(self._targets[self._offsets[node]:self._offsets[node + 1]])
+        neighbours.update(self._overlay.get(node, ()))
+        neighbours.discard(node)
+        return neighbours
+
+    def start(self, session_factory: async_sessionmaker, chunk_size: int = 50_000, max_backoff: float = 60.0):
+        """Loads the graph in the background, from scratch if it is loaded or loading already.
+
+        Failed loads are retried with a backoff that doubles up to `max_backoff` seconds.
+        """
+        if self._task is not None:
+            self._task.cancel()
+        self._reset()
+        self._task = asyncio.create_task(self._keep_loading(session_factory, chunk_size, max_backoff))
+
+    async def stop(self):
+        for task in (self._task, self._compaction):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._compaction = None
+
+    async def _keep_loading(self, session_factory: async_sessionmaker, chunk_size: int, max_backoff: float):
+        backoff = min(1.0, max_backoff)
+        while True:
+            try:
+                await self.load(session_factory, chunk_size)
+                return
+            except (OSError, SQLAlchemyError):
+                logger.exception("Friend graph could not be loaded, retrying in %.0fs", backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, max_backoff)
+
+    async def load(self, session_factory: async_sessionmaker, chunk_size: int = 50_000):
+        """Streams the friendship table and builds the index, edges added meanwhile are applied afterwards"""
+        self._reset()
+        self._loading = True
+        sources, targets = array("I"), array("I")
+        try:
+            async with session_factory() as db:
+                edges = await db.stream(
+                    select(models.Friendship.friend_id_one, models.Friendship.friend_id_two)
+                    .execution_options(yield_per=chunk_size)
+                )
+                async for partition in edges.partitions():
+                    for friend_id_one, friend_id_two in partition:
+                        sources.append(self._node(friend_id_one))
+                        targets.append(self._node(friend_id_two))
+                    if len(sources) > self.max_friendships:
+                        raise MemoryBudgetExceeded(f"more than {self.max_friendships} friendships")
+            self._offsets, self._targets = await self._build(len(self._nodes), sources, targets)
+        except MemoryBudgetExceeded as e:
+            logger.warning("Friend graph is disabled, the friendship table has %s", e)
+            self._reset()
+            return
+        except BaseException:
+            self._reset()
+            raise
+        finally:
+            self._loading = False
+        self.ready = True
+        for friend_id_one, friend_id_two in self._pending:
+            self.add_edge(friend_id_one, friend_id_two)
+        self._pending = []
+        logger.info("Friend graph loaded: %d users, %d friendships", len(self._nodes), len(sources))
+
+    @staticmethod
+    async def _build(nodes: int, sources: array, targets: array) -> Tuple[array, array]:
+        """CSR offsets and targets of `nodes` nodes with edges from `sources` to `targets`, in both directions"""
+        degrees = array("I", bytes(4 * nodes))
+        for i, (source, target) in enumerate(zip(sources, targets)):
+            degrees[source] += 1
+            degrees[target] += 1
+            if i % YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+        offsets = array("I", [0])
+        offsets.extend(accumulate(degrees))
+        adjacency = array("I", bytes(4 * offsets[-1]))
+        free = array("I", offsets)
+        for i, (source, target) in enumerate(zip(sources, targets)):
+            adjacency[free[source]] = target
+            free[source] += 1
+            adjacency[free[target]] = source
+            free[target] += 1
+            if i % YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+        return offsets, adjacency
+
+    def add_edge(self, friend_id_one: UUID, friend_id_two: UUID):
+        if self._loading:
+            self._pending.append((friend_id_one, friend_id_two))
+            return
+        if not self.ready:
+            return
+        try:
+            one, two = self._node(friend_id_one), self._node(friend_id_two)
+        except MemoryBudgetExceeded as e:
+            logger.warning("Friend graph is disabled, there are %s", e)
+            self._reset()
+            return
+        if two in self._overlay.get(one, ()):
+            return
+        self._overlay.setdefault(one, set()).add(two)
+        self._overlay.setdefault(two, set()).add(one)
+        self._overlay_edges += 1
+        if self._overlay_edges >= self.compact_after and (self._compaction is None or self._compaction.done()):
+            self._compaction = asyncio.create_task(self.compact())
+
+    async def compact(self):
+        """Merges the overlay into the CSR arrays, edges added meanwhile stay in the overlay"""
+        generation, nodes = self._generation, len(self._nodes)
+        loaded_offsets, loaded_targets = self._offsets, self._targets
+        overlay = {node: set(neighbours) for node, neighbours in self._overlay.items()}
+        sources, targets = array("I"), array("I")
+        for node in range(len(loaded_offsets) - 1):
+            for target in loaded_targets[loaded_offsets[node]:loaded_offsets[node + 1]]:
+                if node < target:
+                    sources.append(node)
+                    targets.append(target)
+                    overlay.get(node, set()).discard(target)
+                    overlay.get(target, set()).discard(node)
+            if node % YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+        merged = 0
+        for node, neighbours in overlay.items():
+            for target in neighbours:
+                if node < target:
+                    sources.append(node)
+                    targets.append(target)
+                    merged += 1
+        offsets, adjacency = await self._build(nodes, sources, targets)
+        if generation != self._generation:
+            return
+        self._offsets, self._targets = offsets, adjacency
+        for node, neighbours in overlay.items():
+            remaining = self._overlay.get(node, set()) - neighbours
+            if remaining:
+                self._overlay[node] = remaining
+            else:
+                self._overlay.pop(node, None)
+        self._overlay_edges = sum(len(neighbours) for neighbours in self._overlay.values()) // 2
+        logger.info("Friend graph compacted: %d edges merged", merged)
+
+    def _check_ready(self):
+        if not self.ready:
+            raise GraphNotReady
+
+    def friends(self, user_id: UUID) -> List[UUID]:
+        self._check_ready()
+        node = self._nodes.get(user_id.bytes)
+        if node is None:
+            return []
+        return [self._user_id(friend) for friend in self._neighbours(node)]
+
+    def mutual_friends(self, user_id: UUID, other_id: UUID) -> List[UUID]:
+        self._check_ready()
+        node, other = self._nodes.get(user_id.bytes), self._nodes.get(other_id.bytes)
+        if node is None or other is None:
+            return []
+        return [self._user_id(friend) for friend in self._neighbours(node) & self._neighbours(other)]
+
+    def suggestions(self, user_id: UUID, limit: int) -> List[Tuple[UUID, int]]:
+        """Friends of friends who are not friends yet, with the most mutual friends first"""
+        self._check_ready()
+        node = self._nodes.get(user_id.bytes)
+        if node is None:
+            return []
+        friends = self._neighbours(node)
+        candidates: Counter = Counter()
+        for friend in friends:
+            candidates.update(self._neighbours(friend))
+        for excluded in friends | {node}:
+            candidates.pop(excluded, None)
+        return [(self._user_id(candidate), mutual) for candidate, mutual in candidates.most_common(limit)]
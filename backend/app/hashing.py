@@ -0,0 +1,92 @@
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional
+
+from passlib.context import CryptContext
+from prometheus_client import Counter, Histogram
+
+password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+QUEUE_WAIT = Histogram(
+    "password_hash_queue_wait_seconds",
+    "Time a password operation waits for a free worker",
+    ["operation"],
+)
+HASH_TIME = Histogram(
+    "password_hash_duration_seconds",
+    "Time a worker spends hashing or verifying a password",
+    ["operation"],
+)
+REJECTED = Counter(
+    "password_hash_rejected_total",
+    "Password operations rejected because the pool is saturated",
+    ["operation"],
+)
+
+
+class PasswordPoolSaturated(Exception):
+    pass
+
+
+def _run(operation: str, *args):
+    # time.monotonic is system-wide, so it is comparable across pool processes
+    started_at = time.monotonic()
+    result = getattr(password_context, operation)(*args)
+    return result, started_at, time.monotonic() - started_at
+
+
+class PasswordHasher:
+    """Runs bcrypt in a worker pool so it does not block the event loop.
+
+    At most `workers + max_queue` operations are admitted at once. With `fail_fast`
+    an operation that does not fit raises PasswordPoolSaturated instead of waiting.
+    """
+
+    def __init__(self, executor: str = "thread", workers: int = 4, max_queue: int = 64, fail_fast: bool = False):
+        self.executor = executor
+        self.workers = workers
+        self.fail_fast = fail_fast
+        self._slots = asyncio.Semaphore(workers + max_queue)
+        self._pool: Optional[Executor] = None
+
+    def start(self):
+        if self._pool is None:
+            if self.executor == "process":
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    async def _submit(self, operation: str, *args, wait: bool = False):
+        if self.fail_fast and not wait and self._slots.locked():
+            REJECTED.labels(operation).inc()
+            raise PasswordPoolSaturated(operation)
+        submitted_at = time.monotonic()
+        async with self._slots:
+            self.start()
+            loop = asyncio.get_running_loop()
+            result, started_at, elapsed = await loop.run_in_executor(self._pool, _run, operation, *args)
+        QUEUE_WAIT.labels(operation).observe(max(started_at - submitted_at, 0.0))
+        HASH_TIME.labels(operation).observe(elapsed)
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._submit("hash", password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._submit("verify", password, hashed)
+
+    async def hash_many(self, passwords: List[str]) -> List[str]:
+        """Hashes passwords in parallel on all workers but one, which is left to interactive requests"""
+        slots = asyncio.Semaphore(max(self.workers - 1, 1))
+
+        async def hash_one(password: str) -> str:
+            async with slots:
+                return await self._submit("hash", password, wait=True)
+
+        return await asyncio.gather(*(hash_one(password) for password in passwords))
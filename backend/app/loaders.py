@@ -0,0 +1,53 @@
+import asyncio
+from typing import Dict, Iterable, List, Optional
+from uuid import UUID
+
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud
+
+
+class UserLoader:
+    """Request-scoped batcher of user lookups, like DataLoader.
+
+    `load` calls made before the event loop gets back to the loader are answered
+    by one `id = ANY(:ids)` query. Users are looked up at most once per loader,
+    missing ones resolve to None.
+    """
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self._users: Dict[UUID, asyncio.Future] = {}
+        self._queue: List[UUID] = []
+        self._dispatch: Optional[asyncio.Task] = None
+        # batches queued while one is running wait for the session
+        self._lock = asyncio.Lock()
+
+    def load(self, user_id: UUID) -> "asyncio.Future[Optional[Row]]":
+        future = self._users.get(user_id)
+        if future is None:
+            future = self._users[user_id] = asyncio.get_running_loop().create_future()
+            self._queue.append(user_id)
+            if len(self._queue) == 1:
+                self._dispatch = asyncio.create_task(self._load_queued())
+        return future
+
+    async def load_many(self, user_ids: Iterable[UUID]) -> List[Optional[Row]]:
+        return list(await asyncio.gather(*(self.load(user_id) for user_id in user_ids)))
+
+    async def _load_queued(self):
+        # tasks started along with the first load, like gather(load_many(...)), queue theirs meanwhile
+        await asyncio.sleep(0)
+        async with self._lock:
+            user_ids, self._queue = self._queue, []
+            try:
+                users = await crud.get_users_by_ids(self.db, user_ids)
+                users = {user.id: user for user in users.all()}
+            except Exception as e:
+                for user_id in user_ids:
+                    # a later load retries instead of getting the same error
+                    self._users.pop(user_id).set_exception(e)
+                return
+            for user_id in user_ids:
+                self._users[user_id].set_result(users.get(user_id))
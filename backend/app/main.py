@@ -1,37 +1,123 @@
+import datetime
+from html import escape
+from typing import List, Literal, Optional, Tuple
 from uuid import UUID
 
+import asyncio
+import hmac
+import json
+import logging
+import os
+import time
+
 import jwt
 from fastapi import (
     FastAPI,
     HTTPException,
     Depends,
+    Header,
+    Query,
+    Request,
+    Response,
     status,
     WebSocket,
     WebSocketDisconnect,
 )
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from passlib.context import CryptContext
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from prometheus_client import Gauge
 from prometheus_fastapi_instrumentator import Instrumentator
 
-from app.connection_manager import ConnectionManager
+from app.bulk_import import BulkImportError, import_friendships, import_users
+from app.cache import TTLCache
+from app.connection_manager import ConnectionManager, friends_room
 from app.core.config import settings
+from app.db_metrics import QueryCountMiddleware
+from app.export import MEDIA_TYPES, export_users
+from app.friend_graph import FriendGraph, GraphNotReady
+from app.hashing import PasswordHasher, PasswordPoolSaturated, password_context
+from app.loaders import UserLoader
+from app.process_metrics import report_process_metrics
+from app.profiler import ProfilerMiddleware, StackSampler
+from app.pubsub import MessageTooLarge, create_pubsub
+from app.rate_limit import RateLimitMiddleware, create_backend as create_rate_limit_backend
 from app.schemas import User, Friends
+from app.write_behind import LoginDateBuffer, MessageWriter
+
+from app import IMPORT_STARTED_AT, crud, pagination, schemas
+from .database import get_session, get_read_session, engine, Base, async_session, ASYNCPG_DSN
 
-from app import crud, schemas
-from .database import get_session, engine, Base
+logger = logging.getLogger(__name__)
+
+STARTUP_SECONDS = Gauge(
+    "app_startup_seconds", "Time to import the app module and to construct the app, by phase", ["phase"],
+    multiprocess_mode="max",
+)
+IMPORTED_AT = time.perf_counter()
 
 JWT_SECRET = "secret"
 JWT_ALGORITHM = "HS256"
 
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+password_hasher = PasswordHasher(
+    executor=settings.PASSWORD_HASH_EXECUTOR,
+    workers=settings.PASSWORD_HASH_WORKERS,
+    max_queue=settings.PASSWORD_HASH_MAX_QUEUE,
+    fail_fast=settings.PASSWORD_HASH_FAIL_FAST,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+login_dates = LoginDateBuffer(
+    async_session,
+    flush_interval=settings.LOGIN_DATE_FLUSH_INTERVAL,
+    max_size=settings.LOGIN_DATE_FLUSH_SIZE,
+)
+friend_graph = FriendGraph(
+    max_users=settings.FRIEND_GRAPH_MAX_USERS,
+    max_friendships=settings.FRIEND_GRAPH_MAX_FRIENDSHIPS,
+    compact_after=settings.FRIEND_GRAPH_COMPACT_AFTER,
+)
+chat = ConnectionManager(queue_size=settings.CHAT_QUEUE_SIZE, policy=settings.CHAT_SLOW_CONSUMER_POLICY)
+chat_history = MessageWriter(
+    async_session,
+    flush_interval=settings.CHAT_HISTORY_FLUSH_INTERVAL,
+    max_size=settings.CHAT_HISTORY_FLUSH_SIZE,
+    max_pending=settings.CHAT_HISTORY_MAX_PENDING,
+)
+# authenticated users by email, so that authorized requests do not hit the database
+principal_cache = TTLCache("principal", maxsize=settings.PRINCIPAL_CACHE_SIZE, ttl=settings.PRINCIPAL_CACHE_TTL)
+# pub/sub rooms that carry changes of per-process state to every worker, see STATE_ROOM_PREFIX
+FRIENDSHIPS_ROOM = "$friendships"
+PRINCIPALS_ROOM = "$principals"
+
+
+def deliver(room: str, message: str):
+    """Applies a message published by any worker, this one included"""
+    if room == FRIENDSHIPS_ROOM:
+        one, two = message.split()
+        friend_graph.add_edge(UUID(one), UUID(two))
+    elif room == PRINCIPALS_ROOM:
+        principal_cache.invalidate(message)
+    else:
+        chat.broadcast(room, message)
+
+
+def resync():
+    """Rebuilds the state kept in sync by the pub/sub, after messages from other workers may have been missed"""
+    principal_cache.clear()
+    if settings.FRIEND_GRAPH_ENABLED:
+        # answered from the database until it is loaded again
+        friend_graph.start(async_session, chunk_size=settings.FRIEND_GRAPH_LOAD_CHUNK)
+
+
+pubsub = create_pubsub(settings.CHAT_PUBSUB_BACKEND, deliver, dsn=ASYNCPG_DSN, resync=resync)
+stack_sampler = StackSampler(interval=settings.PROFILER_INTERVAL, max_stacks=settings.PROFILER_MAX_STACKS)
+rate_limit_backend = create_rate_limit_backend(settings.RATE_LIMIT_BACKEND, settings.RATE_LIMIT_REDIS_URL)
 
 
 def get_application():
-    _app = FastAPI(title=settings.PROJECT_NAME)
+    _app = FastAPI(title=settings.PROJECT_NAME, default_response_class=ORJSONResponse)
     _app.add_middleware(
         CORSMiddleware,
         allow_origins=[str(origin) for origin in settings.BACKEND_CORS_ORIGINS],
@@ -39,6 +125,27 @@ def get_application():
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    _app.add_middleware(QueryCountMiddleware)
+    if settings.PROFILER_ENABLED:
+        _app.add_middleware(
+            ProfilerMiddleware,
+            sampler=stack_sampler,
+            sample_rate=settings.PROFILER_SAMPLE_RATE,
+            threshold=settings.PROFILER_THRESHOLD,
+            token=settings.PROFILER_TOKEN,
+        )
+    if settings.RATE_LIMIT_ENABLED:
+        # outermost, so rejected requests cost as little as possible
+        _app.add_middleware(
+            RateLimitMiddleware,
+            backend=rate_limit_backend,
+            client_rate=settings.RATE_LIMIT_CLIENT_RATE,
+            client_burst=settings.RATE_LIMIT_CLIENT_BURST,
+            weights=settings.RATE_LIMIT_WEIGHTS,
+            route_rates=settings.RATE_LIMIT_ROUTE_RATES,
+            max_concurrency=settings.RATE_LIMIT_MAX_CONCURRENCY,
+            trust_forwarded=settings.RATE_LIMIT_TRUST_FORWARDED,
+        )
 
     return _app
 
@@ -48,6 +155,79 @@ app = get_application()
 Instrumentator().instrument(app).expose(app)  # added /metrics endpoint
 
 
+@app.on_event("startup")
+async def start_password_hasher():
+    password_hasher.start()
+
+
+@app.on_event("shutdown")
+async def stop_password_hasher():
+    password_hasher.shutdown()
+
+
+@app.on_event("startup")
+async def start_login_dates():
+    login_dates.start()
+
+
+@app.on_event("shutdown")
+async def stop_login_dates():
+    await login_dates.stop()
+
+
+@app.on_event("startup")
+async def start_chat_history():
+    chat_history.start()
+
+
+@app.on_event("shutdown")
+async def stop_chat_history():
+    await chat_history.stop()
+
+
+@app.on_event("startup")
+async def start_pubsub():
+    await pubsub.start()
+
+
+@app.on_event("shutdown")
+async def stop_pubsub():
+    await pubsub.stop()
+
+
+@app.on_event("startup")
+async def start_process_metrics():
+    app.state.process_metrics = asyncio.create_task(report_process_metrics(settings.PROCESS_METRICS_INTERVAL))
+
+
+@app.on_event("shutdown")
+async def stop_process_metrics():
+    app.state.process_metrics.cancel()
+
+
+@app.on_event("shutdown")
+async def close_rate_limit_backend():
+    await rate_limit_backend.close()
+
+
+@app.on_event("startup")
+async def load_friend_graph():
+    # requests are served from the database until the graph is loaded
+    if settings.FRIEND_GRAPH_ENABLED:
+        friend_graph.start(async_session, chunk_size=settings.FRIEND_GRAPH_LOAD_CHUNK)
+
+
+@app.on_event("shutdown")
+async def stop_friend_graph():
+    await friend_graph.stop()
+
+
+@app.exception_handler(PasswordPoolSaturated)
+async def password_pool_saturated_handler(request, exc):
+    return JSONResponse(status_code=503, content={"detail": "Server is busy, try again later"},
+                        headers={"Retry-After": "1"})
+
+
 # @app.on_event("startup")
 # async def init_tables():
 #     async with engine.begin() as conn:
@@ -56,55 +236,83 @@ Instrumentator().instrument(app).expose(app)  # added /metrics endpoint
 
 
 async def authenticate_user(email: str, password: str, db: AsyncSession):
-    user_password = await crud.get_user_password(db, email)
-    user_password = user_password.scalars().one()
-    if user_password:
-        if password_context.verify(password, user_password):
-            user = await crud.get_user_by_email(db, email)
-            return user.scalars().one()
+    user = await crud.get_user_credentials(db, email)
+    user = user.one_or_none()
+    if user:
+        if await password_hasher.verify(password, user.password):
+            return user
     return False
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_session)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def get_user_by_token(token: str, db: AsyncSession) -> Optional[schemas.UserPublic]:
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        email: str = payload.get("username")
-        if email is None:
-            raise credentials_exception
-    except Exception:
-        raise credentials_exception
+    except jwt.PyJWTError:
+        return None
+    email = payload.get("email")
+    if email is None:
+        return None
+    user = principal_cache.get(email)
+    if user:
+        return user
     user = await crud.get_user_by_email(db, email)
-    user = user.scalars().one()
+    user = user.scalars().one_or_none()
+    if user:
+        user = schemas.UserPublic.from_orm(user)
+        principal_cache.set(email, user)
+    return user
+
+
+def get_user_loader(db: AsyncSession = Depends(get_session)) -> UserLoader:
+    return UserLoader(db)
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_session)):
+    user = await get_user_by_token(token, db)
     if user:
         return user
-    raise credentials_exception
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
 
 
 @app.post("/users/", tags=["user"], description="Create new user")
 async def create_user(user: schemas.User, db: AsyncSession = Depends(get_session)):
-    db_user = await crud.get_user_by_email(db, email=user.email)
-    db_user = db_user.scalars().one_or_none()
-    if db_user:
+    user.password = await password_hasher.hash(user.password)
+    try:
+        user_id = await crud.create_user(db=db, user=user)
+    except IntegrityError:
+        # the email conflict is handled by the insert, so only the id can collide
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="User id already exists")
+    if user_id is None:
         raise HTTPException(status_code=400, detail="Email already registered")
-    user.password = password_context.hash(user.password)
-    return await crud.create_user(db=db, user=user)
+    return user_id
+
+
+@app.post("/users/bulk", tags=["user"], response_model=schemas.BulkImportReport,
+          description="Import users from the request body: NDJSON, or CSV with a header when Content-Type is text/csv")
+async def create_users(request: Request, db: AsyncSession = Depends(get_session)):
+    format = "csv" if request.headers.get("content-type", "").startswith("text/csv") else "ndjson"
+    try:
+        return await import_users(db, request.stream(), format, password_hasher,
+                                  chunk_size=settings.BULK_IMPORT_CHUNK_SIZE, max_errors=settings.BULK_IMPORT_MAX_ERRORS)
+    except BulkImportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post("/users/login", tags=["user"], description="Login user")
 async def login_user(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_session)):
     user = await authenticate_user(form_data.username, form_data.password, db)
-    await crud.update_login_date(db, user_id=user.id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect login or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    login_dates.add(user.id)
     return {
         "token": jwt.encode(
             {"email": user.email}, JWT_SECRET, algorithm=JWT_ALGORITHM
@@ -120,43 +328,200 @@ async def update_user(user_id: UUID, new_user: User, db: AsyncSession = Depends(
     user = await crud.get_user(db, user_id)
     user = user.scalars().one_or_none()
     if user:
-        await crud.update_user(db, user_id, new_user)
+        try:
+            await crud.update_user(db, user_id, new_user)
+        except IntegrityError:
+            # the unique index on lower(email)
+            await db.rollback()
+            raise HTTPException(status_code=400, detail="Email already registered")
+        for email in {user.email, new_user.email}:
+            principal_cache.invalidate(email)
+            await pubsub.publish(PRINCIPALS_ROOM, email)
         return new_user
     raise HTTPException(status_code=404, detail="User not found")
 
 
-@app.get("/users/{user_id}", tags=["user"], description="Get user by id")
-async def get_user(user_id: UUID, db: AsyncSession = Depends(get_session)):
-    db_user = await crud.get_user(db, user_id)
-    user = db_user.scalars().one_or_none()
+# declared before /users/{user_id}, which would match it otherwise
+@app.get("/users/export", tags=["users"], response_class=StreamingResponse,
+         description="Stream all users as NDJSON or CSV, optionally only those who logged in "
+                     "from login_from (inclusive) until login_until (exclusive)")
+async def export_all_users(format: Literal["ndjson", "csv"] = "ndjson",
+                           login_from: Optional[datetime.datetime] = None,
+                           login_until: Optional[datetime.datetime] = None,
+                           chunk_size: int = Query(default=settings.EXPORT_CHUNK_SIZE, gt=0, le=100_000),
+                           db: AsyncSession = Depends(get_read_session)):
+    users = await crud.stream_users(db, login_from, login_until, chunk_size=chunk_size)
+    # the session is closed after the response is sent
+    return StreamingResponse(export_users(users, format), media_type=MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="users.{format}"'})
+
+
+@app.get("/users/search", tags=["users"], response_model=schemas.UserSearchPage,
+         description="Find users whose name or description has words similar to q, best matches first, "
+                     "pass next_cursor to get the next page")
+async def search_users(q: str = Query(min_length=3, max_length=100), cursor: Optional[str] = None,
+                       limit: int = Query(default=20, gt=0, le=100), db: AsyncSession = Depends(get_read_session)):
+    after = None
+    if cursor is not None:
+        try:
+            score, user_id = pagination.decode_cursor(cursor, 2)
+            after = (float(score), UUID(user_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    users = await crud.search_users(db, q, after=after, limit=limit)
+    users = users.all()
+    next_cursor = pagination.encode_cursor(repr(users[-1].score), users[-1].id) if len(users) == limit else None
+    return ORJSONResponse({"items": [user._asdict() for user in users], "next_cursor": next_cursor})
+
+
+@app.get("/users/autocomplete", tags=["users"], response_model=List[schemas.UserPublic],
+         description="Users whose name starts with prefix, in alphabetical order")
+async def autocomplete_users(prefix: str = Query(min_length=1, max_length=30),
+                             limit: int = Query(default=10, gt=0, le=50),
+                             db: AsyncSession = Depends(get_read_session)):
+    users = await crud.autocomplete_users(db, prefix, limit=limit)
+    return ORJSONResponse([user._asdict() for user in users.all()])
+
+
+def user_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match compares weakly, W/ prefixes are ignored
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+@app.get("/users/{user_id}", tags=["user"], response_model=schemas.UserProfile,
+         description="Get user by id, answers 304 when If-None-Match has the user's current ETag")
+async def get_user(user_id: UUID, if_none_match: Optional[str] = Header(default=None),
+                   db: AsyncSession = Depends(get_read_session)):
+    if if_none_match is not None:
+        version = await crud.get_user_version(db, user_id)
+        version = version.scalar_one_or_none()
+        if version is not None and etag_matches(if_none_match, user_etag(version)):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": user_etag(version)})
+    user = await crud.get_public_user(db, user_id)
+    user = user.one_or_none()
     if user:
-        return user
+        user = user._asdict()
+        etag = user_etag(user.pop("version"))
+        # rows of public columns need no validation, orjson encodes uuids and datetimes itself
+        return ORJSONResponse(user, headers={"ETag": etag})
     raise HTTPException(status_code=404, detail=f"User not found")
 
 
-@app.get("/users/", tags=["users"], description="Get all users")
-async def get_users(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_session)):
-    users = await crud.get_users(db, skip=skip, limit=limit)
-    return users.scalars().all()
-
-
-@app.post("/users/friends/", tags=["friendship"], description="Create friendship between user1 and user2 by their ids")
-async def create_friends(friends: Friends, db: AsyncSession = Depends(get_session)):
-    first_id_exists = await crud.get_user(db, friends.id_friend_one)
-    second_id_exists = await crud.get_user(db, friends.id_friend_two)
-    if first_id_exists.scalars().one_or_none() and second_id_exists.scalars().one_or_none():
-        return await crud.create_friendship(db, friends)
+@app.get("/users/", tags=["users"], description="Get users page by page, pass next_cursor to get the next page",
+         response_model=schemas.UserPage)
+async def get_users(cursor: Optional[str] = None, limit: int = Query(default=100, gt=0, le=1000),
+                    db: AsyncSession = Depends(get_read_session)):
+    after = None
+    if cursor is not None:
+        try:
+            after = UUID(pagination.decode_cursor(cursor, 1)[0])
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    users = await crud.get_users(db, after=after, limit=limit)
+    users = users.all()
+    next_cursor = pagination.encode_cursor(users[-1].id) if len(users) == limit else None
+    return ORJSONResponse({"items": [user._asdict() for user in users], "next_cursor": next_cursor})
+
+
+@app.post("/users/batch", tags=["users"], response_model=List[schemas.UserPublic],
+          description="Get users by ids in one query, in the order of the ids, unknown ids are skipped")
+async def get_users_batch(user_ids: schemas.UserIds, db: AsyncSession = Depends(get_read_session)):
+    if len(user_ids.ids) > settings.USERS_BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {settings.USERS_BATCH_MAX_IDS} ids can be requested")
+    users = await UserLoader(db).load_many(dict.fromkeys(user_ids.ids))
+    return ORJSONResponse([user._asdict() for user in users if user is not None])
+
+
+async def friendships_created(pairs: List[Tuple[UUID, UUID]]):
+    """Adds new friendships to the graph of this worker right away, and of the others through the pub/sub"""
+    if not settings.FRIEND_GRAPH_ENABLED:
+        return
+    for one, two in pairs:
+        friend_graph.add_edge(one, two)
+        await pubsub.publish(FRIENDSHIPS_ROOM, f"{one} {two}")
+
+
+@app.post("/users/friends/", tags=["friendship"],
+          description="Create friendship between user1 and user2 by their ids, returns it with the smaller id first")
+async def create_friends(friends: Friends, db: AsyncSession = Depends(get_session),
+                         users: UserLoader = Depends(get_user_loader)):
+    if friends.id_friend_one == friends.id_friend_two:
+        raise HTTPException(status_code=400, detail="User can not befriend themselves")
+    if all(await users.load_many([friends.id_friend_one, friends.id_friend_two])):
+        one, two = crud.canonical_pair(friends.id_friend_one, friends.id_friend_two)
+        if await crud.create_friendship(db, friends):
+            await friendships_created([(one, two)])
+        return {"friend_id_one": one, "friend_id_two": two}
     raise HTTPException(status_code=404,
                         detail=f"User with id {friends.id_friend_one} or with id {friends.id_friend_two} not found")
 
 
-# todo fix
-@app.get("/get_friends/", tags=["users"], description="Get all users")
-async def get_users(user_id: UUID, db: AsyncSession = Depends(get_session)):
-    users = await crud.get_friends(db, user_id)
-    return users.scalars().all()
+@app.post("/users/friends/bulk", tags=["friendship"], response_model=schemas.FriendshipImportReport,
+          description="Import friendships from an NDJSON body of {\"id_friend_one\": ..., \"id_friend_two\": ...} lines")
+async def create_friendships(request: Request, db: AsyncSession = Depends(get_session)):
+    try:
+        return await import_friendships(db, request.stream(), friendships_created,
+                                        chunk_size=settings.BULK_FRIENDSHIP_CHUNK_SIZE,
+                                        max_errors=settings.BULK_IMPORT_MAX_ERRORS)
+    except BulkImportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 
-html = """
+@app.get("/get_friends/", tags=["users"], description="Get all friends of the user",
+         response_model=List[schemas.UserPublic])
+async def get_friends(user_id: UUID, db: AsyncSession = Depends(get_read_session)):
+    try:
+        friend_ids = friend_graph.friends(user_id)
+    except GraphNotReady:
+        users = await crud.get_friends(db, user_id)
+        return users.all()
+    if not friend_ids:
+        return []
+    users = await crud.get_users_by_ids(db, friend_ids)
+    return users.all()
+
+
+@app.get("/users/{user_id}/friends/mutual", tags=["friendship"], description="Get friends the two users have in common",
+         response_model=List[schemas.UserPublic])
+async def get_mutual_friends(user_id: UUID, other_id: UUID, db: AsyncSession = Depends(get_read_session)):
+    try:
+        friend_ids = friend_graph.mutual_friends(user_id, other_id)
+    except GraphNotReady:
+        user_friends = await crud.get_friend_ids(db, user_id)
+        other_friends = await crud.get_friend_ids(db, other_id)
+        friend_ids = list(set(user_friends.scalars()) & set(other_friends.scalars()))
+    if not friend_ids:
+        return []
+    users = await crud.get_users_by_ids(db, friend_ids)
+    return users.all()
+
+
+@app.get("/users/{user_id}/friends/suggestions", tags=["friendship"],
+         description="Suggest friends of friends, the ones with more mutual friends first",
+         response_model=List[schemas.FriendSuggestion])
+async def get_friend_suggestions(user_id: UUID, limit: int = Query(default=10, gt=0, le=100),
+                                 db: AsyncSession = Depends(get_read_session)):
+    try:
+        suggestions = friend_graph.suggestions(user_id, limit)
+    except GraphNotReady:
+        rows = await crud.get_friend_suggestions(db, user_id, limit)
+        suggestions = [(row.candidate, row.mutual_friends) for row in rows]
+    if not suggestions:
+        return []
+    users = await crud.get_users_by_ids(db, [suggestion_id for suggestion_id, _ in suggestions])
+    users = {user.id: user for user in users.all()}
+    return [
+        schemas.FriendSuggestion(user=users[suggestion_id], mutual_friends=mutual_friends)
+        for suggestion_id, mutual_friends in suggestions if suggestion_id in users
+    ]
+
+chat_html = """
 <!DOCTYPE html>
 <html>
     <head>
@@ -164,7 +529,7 @@ html = """
     </head>
     <body>
         <h1>WebSocket Chat</h1>
-        <h2>Your ID: <span id="ws-id"></span></h2>
+        <h2>CHAT_HEADING</h2>
         <form action="" onsubmit="sendMessage(event)">
             <input type="text" id="messageText" autocomplete="off"/>
             <button>Send</button>
@@ -172,9 +537,12 @@ html = """
         <ul id='messages'>
         </ul>
         <script>
-            var client_id = Date.now()
-            document.querySelector("#ws-id").textContent = client_id;
-            var ws = new WebSocket(`ws://0.0.0.0:5000/ws/${client_id}`);
+            var scheme = location.protocol === "https:" ? "wss" : "ws"
+            var ws = new WebSocket(`${scheme}://${location.host}CHAT_WS_PATH`);
+            var ticket = CHAT_TICKET
+            if (ticket) {
+                ws.onopen = function() { ws.send(ticket) };
+            }
             ws.onmessage = function(event) {
                 var messages = document.getElementById('messages')
                 var message = document.createElement('li')
@@ -194,9 +562,62 @@ html = """
 """
 
 
+def chat_page(heading: str, ws_path: str, ticket: Optional[str] = None) -> HTMLResponse:
+    """The chat page, connected to the websocket at `ws_path` of the host that served it.
+
+    The page sends `ticket` as the first message of the websocket, so that it never shows up in a URL.
+    """
+    return HTMLResponse(
+        chat_html.replace("CHAT_HEADING", escape(heading)).replace("CHAT_WS_PATH", ws_path)
+        .replace("CHAT_TICKET", json.dumps(ticket))
+    )
+
+
+def create_chat_ticket(user: schemas.UserPublic, friend_id: UUID) -> str:
+    """Short-lived token that opens the chat with one friend only, it is not accepted as a bearer token"""
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=settings.CHAT_TICKET_TTL)
+    return jwt.encode(
+        {"chat_user": str(user.id), "name": user.name, "friend": str(friend_id), "exp": expires},
+        JWT_SECRET, algorithm=JWT_ALGORITHM,
+    )
+
+
+def read_chat_ticket(ticket: str, friend_id: UUID) -> Optional[Tuple[UUID, str]]:
+    """Id and name of the user the ticket was issued to, None if it is invalid, expired or for another chat"""
+    try:
+        payload = jwt.decode(ticket, JWT_SECRET, algorithms=[JWT_ALGORITHM], options={"require": ["exp"]})
+        if payload.get("friend") != str(friend_id):
+            return None
+        return UUID(payload["chat_user"]), payload["name"]
+    except (jwt.PyJWTError, KeyError, TypeError, ValueError):
+        return None
+
+
+def check_admin_token(x_admin_token: Optional[str] = Header(default=None)):
+    if not settings.PROFILER_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, settings.PROFILER_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.get("/admin/profile", tags=["admin"], dependencies=[Depends(check_admin_token)],
+         description="Stacks sampled in slow requests, in the collapsed format of flamegraph.pl. "
+                     "Every worker process keeps its own stacks, this returns the ones of the worker "
+                     "whose pid is in X-Worker-Pid, repeat the request to collect the others")
+async def get_profile():
+    return PlainTextResponse(stack_sampler.collapsed(), headers={"X-Worker-Pid": str(os.getpid())})
+
+
+@app.delete("/admin/profile", tags=["admin"], dependencies=[Depends(check_admin_token)],
+            description="Forget sampled stacks")
+async def reset_profile():
+    stack_sampler.reset()
+
+
 @app.get("/", tags=["chat"])
 async def create_chat():
-    return HTMLResponse(html)
+    client_id = time.time_ns() // 1_000_000
+    return chat_page(f"Your ID: {client_id}", f"/ws/{client_id}")
 
 
 @app.get(
@@ -204,27 +625,104 @@ async def create_chat():
     tags=["chat"],
     description="Create a chat between two friends",
 )
-async def create_chat(friend_id: UUID, user: User = Depends(get_current_user), db: AsyncSession = Depends(get_session)):
-    db_user = await crud.get_user(db, friend_id)
-    user = db_user.scalars().one_or_none()
-    if user:
+async def create_chat(friend_id: UUID, user: User = Depends(get_current_user), db: AsyncSession = Depends(get_session),
+                      users: UserLoader = Depends(get_user_loader)):
+    friend = await users.load(friend_id)
+    if friend:
         friends = await crud.find_friendship(db, friend_id, user.id)
-        if friends:
-            return HTMLResponse(html)
+        if friends.first():
+            return chat_page(f"Chat with {friend.name}", f"/ws/friends/{friend_id}", create_chat_ticket(user, friend_id))
         raise HTTPException(
             status_code=403, detail=f"User with id {friend_id} is not your friend"
         )
     raise HTTPException(status_code=404, detail=f"User with id {friend_id} not found")
 
 
+@app.get(
+    "/users/friends/chat/history",
+    tags=["chat"],
+    description="Get messages of the chat with a friend, newest first, pass next_cursor to get older ones",
+    response_model=schemas.MessagePage,
+)
+async def get_chat_history(friend_id: UUID, cursor: Optional[str] = None,
+                           limit: int = Query(default=50, gt=0, le=500),
+                           user: User = Depends(get_current_user), db: AsyncSession = Depends(get_session)):
+    before = None
+    if cursor is not None:
+        try:
+            created_at, message_id = pagination.decode_cursor(cursor, 2)
+            before = (datetime.datetime.fromisoformat(created_at), int(message_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    friends = await crud.find_friendship(db, friend_id, user.id)
+    if not friends.first():
+        raise HTTPException(status_code=403, detail=f"User with id {friend_id} is not your friend")
+    messages = await crud.get_messages(db, friends_room(user.id, friend_id), before=before, limit=limit)
+    messages = messages.all()
+    next_cursor = None
+    if len(messages) == limit:
+        next_cursor = pagination.encode_cursor(messages[-1].created_at.isoformat(), messages[-1].id)
+    return schemas.MessagePage(items=messages, next_cursor=next_cursor)
+
+
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: int):
-    manager = ConnectionManager()
-    await manager.connect(websocket)
+    connection = await chat.connect(websocket, "lobby")
     try:
         while True:
             data = await websocket.receive_text()
-            await manager.broadcast(f"Client #{client_id} says: {data}")
+            try:
+                await pubsub.publish(connection.room, f"Client #{client_id} says: {data}")
+            except MessageTooLarge as e:
+                await websocket.send_text(str(e))
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        await manager.broadcast(f"Client #{client_id} left the chat")
+        chat.disconnect(connection)
+        await pubsub.publish(connection.room, f"Client #{client_id} left the chat")
+
+
+@app.websocket("/ws/friends/{friend_id}")
+async def friends_websocket_endpoint(websocket: WebSocket, friend_id: UUID, db: AsyncSession = Depends(get_session)):
+    # the first message is the ticket of the chat page, nothing is joined before it is checked
+    await websocket.accept()
+    try:
+        ticket = await asyncio.wait_for(websocket.receive_text(), settings.CHAT_TICKET_TTL)
+    except asyncio.TimeoutError:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    except WebSocketDisconnect:
+        return
+    user = read_chat_ticket(ticket, friend_id)
+    if not user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    user_id, user_name = user
+    friends = await crud.find_friendship(db, friend_id, user_id)
+    if not friends.first():
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    # the session is not needed while the chat is open
+    await db.close()
+    connection = chat.join(websocket, friends_room(user_id, friend_id))
+    try:
+        while True:
+            data = await websocket.receive_text()
+            try:
+                await pubsub.publish(connection.room, f"{user_name}: {data}")
+            except MessageTooLarge as e:
+                await websocket.send_text(str(e))
+                continue
+            chat_history.add(connection.room, user_id, data)
+    except WebSocketDisconnect:
+        chat.disconnect(connection)
+
+
+# every route is registered by now
+constructed_in = time.perf_counter() - IMPORTED_AT
+logger.info("App imported in %.3fs and constructed in %.3fs", IMPORTED_AT - IMPORT_STARTED_AT, constructed_in)
+
+
+@app.on_event("startup")
+async def report_startup_seconds():
+    # reported by every worker, gunicorn wipes the metrics written while it preloaded the app
+    STARTUP_SECONDS.labels("import").set(IMPORTED_AT - IMPORT_STARTED_AT)
+    STARTUP_SECONDS.labels("construct").set(constructed_in)
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, func
+from sqlalchemy import BigInteger, CheckConstraint, Column, ForeignKey, Identity, Index, Integer, String, DateTime, collate, \
+    func
 from sqlalchemy.dialects.postgresql import UUID
 
 from .database import Base
@@ -12,10 +13,39 @@ class User(Base):
     age = Column(Integer)
     email = Column(String)
     password = Column(String)
-    login_date = Column(DateTime, default=None)
+    login_date = Column(DateTime(timezone=True), default=None)
+    # bumped by every update of the public columns, ETags of users are built from it
+    version = Column(Integer, nullable=False, server_default="1")
+    # kept in step with friendship by crud.create_friendship
+    friend_count = Column(Integer, nullable=False, server_default="0")
+
+
+# emails are unique regardless of case, lookups must compare lower(email) to use it
+Index("ix_users_email_lower", func.lower(User.email), unique=True)
+# trigram indexes of the search, they need the pg_trgm extension
+Index("ix_users_name_trgm", User.name, postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"})
+Index("ix_users_description_trgm", User.description, postgresql_using="gin",
+      postgresql_ops={"description": "gin_trgm_ops"})
+# name autocomplete, the C collation lets LIKE 'prefix%' scan a range of the index, in order
+Index("ix_users_name_prefix", collate(func.lower(User.name), "C"), User.id)
 
 
 class Friendship(Base):
+    """A friendship is stored once, with the smaller id first, see crud.canonical_pair"""
     __tablename__ = 'friendship'
+    __table_args__ = (CheckConstraint("friend_id_one < friend_id_two", name="ck_friendship_canonical"),)
     friend_id_one = Column(UUID, ForeignKey('users.id'), index=True, primary_key=True)
     friend_id_two = Column(UUID, ForeignKey('users.id'),  index=True, primary_key=True)
+
+
+class Message(Base):
+    __tablename__ = 'messages'
+    id = Column(BigInteger, Identity(), primary_key=True)
+    room = Column(String, nullable=False)
+    sender_id = Column(UUID, ForeignKey('users.id'), nullable=False)
+    text = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+
+# history of a room is read newest first, id orders messages created at the same time
+Index("ix_messages_room_created_at", Message.room, Message.created_at, Message.id)
@@ -0,0 +1,23 @@
+import base64
+import binascii
+from typing import List
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*parts) -> str:
+    raw = "|".join(str(part) for part in parts).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> List[str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+    parts = raw.split("|")
+    if len(parts) != size:
+        raise InvalidCursor(cursor)
+    return parts
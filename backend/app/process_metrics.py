@@ -0,0 +1,37 @@
+import asyncio
+import logging
+
+from prometheus_client import Gauge
+from prometheus_client.process_collector import ProcessCollector
+
+logger = logging.getLogger(__name__)
+
+# prometheus_client's process_* metrics describe only the process serving /metrics, and in multiprocess
+# mode they are not exported at all, so every worker reports its own usage, by pid under gunicorn
+WORKER_CPU_SECONDS = Gauge("worker_cpu_seconds", "CPU time of the worker process, user and system",
+                           multiprocess_mode="liveall")
+WORKER_RESIDENT_MEMORY = Gauge("worker_resident_memory_bytes", "Resident memory of the worker process",
+                               multiprocess_mode="liveall")
+WORKER_VIRTUAL_MEMORY = Gauge("worker_virtual_memory_bytes", "Virtual memory of the worker process",
+                              multiprocess_mode="liveall")
+
+GAUGES = {
+    "process_cpu_seconds_total": WORKER_CPU_SECONDS,
+    "process_resident_memory_bytes": WORKER_RESIDENT_MEMORY,
+    "process_virtual_memory_bytes": WORKER_VIRTUAL_MEMORY,
+}
+
+
+async def report_process_metrics(interval: float):
+    """Copies the usage of this process from /proc into the worker gauges every `interval` seconds"""
+    # not registered, it is only read here
+    collector = ProcessCollector(registry=None)
+    while True:
+        try:
+            for metric in collector.collect():
+                for sample in metric.samples:
+                    if sample.name in GAUGES:
+                        GAUGES[sample.name].set(sample.value)
+        except Exception:
+            logger.warning("Process metrics could not be read", exc_info=True)
+        await asyncio.sleep(interval)
@@ -0,0 +1,127 @@
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List, Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.db_metrics import route_path
+
+MAX_DEPTH = 128
+
+
+def collapse(frame) -> str:
+    """Stack in the collapsed format of flamegraph.pl, outermost frame first"""
+    frames = []
+    while frame is not None and len(frames) < MAX_DEPTH:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class Profile:
+    def __init__(self, thread_id: int):
+        self.root = ""
+        self.thread_id = thread_id
+        self.stacks: Counter = Counter()
+
+
+class StackSampler:
+    """Samples stacks of the event loop thread while profiled requests are in flight.
+
+    Other requests run on the same thread in between, so a profile shows everything
+    that kept the loop busy during the request, which is what makes it slow.
+    The sampling thread only runs while there is something to profile.
+    Stacks are kept in the worker process that sampled them.
+    """
+
+    def __init__(self, interval: float, max_stacks: int):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks: Counter = Counter()
+        self.dropped = 0
+        self._profiles: List[Profile] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def begin(self) -> Profile:
+        profile = Profile(threading.get_ident())
+        with self._lock:
+            self._profiles.append(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+        return profile
+
+    def end(self, profile: Profile, keep: bool):
+        with self._lock:
+            self._profiles.remove(profile)
+            if not keep:
+                return
+            for stack, count in profile.stacks.items():
+                stack = f"{profile.root};{stack}"
+                if stack in self.stacks or len(self.stacks) < self.max_stacks:
+                    self.stacks[stack] += count
+                else:
+                    self.dropped += count
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                frames = sys._current_frames()
+                for profile in self._profiles:
+                    frame = frames.get(profile.thread_id)
+                    if frame is not None:
+                        profile.stacks[collapse(frame)] += 1
+                del frames
+            time.sleep(self.interval)
+
+    def collapsed(self) -> str:
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.dropped = 0
+
+
+class ProfilerMiddleware:
+    """Profiles a `sample_rate` share of requests and keeps the ones slower than `threshold` seconds.
+
+    A request with the `x-profile` header equal to `token` is always profiled and kept.
+    """
+
+    def __init__(self, app: ASGIApp, sampler: StackSampler, sample_rate: float, threshold: float,
+                 token: Optional[str] = None):
+        self.app = app
+        self.sampler = sampler
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.token = token.encode() if token else None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        profile_header = dict(scope["headers"]).get(b"x-profile")
+        forced = self.token is not None and profile_header is not None and hmac.compare_digest(profile_header, self.token)
+        if not forced and random.random() >= self.sample_rate:
+            await self.app(scope, receive, send)
+            return
+        profile = self.sampler.begin()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # the request is the root frame, so that flamegraphs split by route
+            profile.root = f"{scope['method']} {route_path(scope)}"
+            self.sampler.end(profile, keep=forced or time.perf_counter() - start >= self.threshold)
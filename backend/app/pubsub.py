@@ -0,0 +1,207 @@
+import abc
+import asyncio
+import itertools
+import json
+import logging
+from typing import Callable, List, Optional, Tuple
+
+import asyncpg
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_BATCH_SIZE = Histogram(
+    "chat_pubsub_batch_messages",
+    "Chat messages sent in one round trip to the pub/sub backend",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+PUBLISH_DROPPED = Counter(
+    "chat_pubsub_dropped_messages_total",
+    "Chat messages dropped because the pub/sub backend was unavailable for too long",
+)
+
+Deliver = Callable[[str, str], None]
+Resync = Callable[[], None]
+
+# rooms of messages that keep per-process state in sync, chat rooms never start with it
+STATE_ROOM_PREFIX = "$"
+
+
+class MessageTooLarge(ValueError):
+    pass
+
+
+class PubSub(abc.ABC):
+    """Delivers messages published by any worker to every worker.
+
+    `deliver(room, message)` is called for every message, including the ones
+    published by this worker. Besides chat rooms, the app uses it to keep
+    per-process state like caches in sync, in rooms starting with STATE_ROOM_PREFIX,
+    whose messages are never dropped. `resync()` is called when messages from other
+    workers may have been missed, the state has to be rebuilt from the database then.
+    """
+
+    def __init__(self, deliver: Deliver, resync: Optional[Resync] = None):
+        self.deliver = deliver
+        self.resync = resync
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abc.abstractmethod
+    async def publish(self, room: str, message: str):
+        ...
+
+
+class InMemoryPubSub(PubSub):
+    """Delivers messages within the process, for a single worker and for tests"""
+
+    async def publish(self, room: str, message: str):
+        self.deliver(room, message)
+
+
+class PostgresPubSub(PubSub):
+    """Delivers messages through Postgres LISTEN/NOTIFY.
+
+    Messages published within `flush_interval` are sent in one round trip, packed
+    into JSON payloads of at most `max_payload` bytes (NOTIFY allows 8000). Each
+    payload starts with a sequence number, since Postgres delivers identical
+    payloads of one transaction only once. Messages of a failed round trip are
+    retried after `retry_interval`, up to `max_pending` chat messages are kept.
+
+    Notifications sent while the listener reconnects are lost, so a reconnect
+    calls `resync()`.
+    """
+
+    channel = "chat"
+    # "[", the sequence number of at most 20 digits, "," and "]"
+    payload_overhead = 23
+
+    def __init__(self, deliver: Deliver, dsn: str, resync: Optional[Resync] = None, flush_interval: float = 0.005,
+                 max_payload: int = 7900, retry_interval: float = 1.0, max_pending: int = 10_000):
+        super().__init__(deliver, resync)
+        self.dsn = dsn
+        self.flush_interval = flush_interval
+        self.max_payload = max_payload
+        self.retry_interval = retry_interval
+        self.max_pending = max_pending
+        self._sequence = itertools.count()
+        self._pending: List[Tuple[str, str]] = []
+        self._wake = asyncio.Event()
+        self._listener: Optional[asyncpg.Connection] = None
+        self._publisher: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self._listen()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            await self._flush()
+        for connection in (self._listener, self._publisher):
+            if connection is not None and not connection.is_closed():
+                connection.remove_termination_listener(self._on_terminated)
+                await connection.close()
+
+    async def _listen(self):
+        self._listener = await asyncpg.connect(self.dsn)
+        self._listener.add_termination_listener(self._on_terminated)
+        await self._listener.add_listener(self.channel, self._on_notify)
+
+    def _on_terminated(self, connection: asyncpg.Connection):
+        if connection is self._listener:
+            logger.warning("Chat listener connection is lost, reconnecting")
+            asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        while True:
+            try:
+                await self._listen()
+            except (OSError, asyncpg.PostgresError):
+                logger.exception("Chat listener could not reconnect")
+                await asyncio.sleep(1)
+                continue
+            if self.resync is not None:
+                self.resync()
+            return
+
+    def _on_notify(self, connection, pid: int, channel: str, payload: str):
+        _sequence, *messages = json.loads(payload)
+        for room, message in messages:
+            self.deliver(room, message)
+
+    async def publish(self, room: str, message: str):
+        if len(json.dumps([room, message], ensure_ascii=False).encode()) + self.payload_overhead > self.max_payload:
+            raise MessageTooLarge(f"message is longer than {self.max_payload - self.payload_overhead} bytes")
+        self._pending.append((room, message))
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            # let messages published meanwhile join the batch
+            await asyncio.sleep(self.flush_interval)
+            self._wake.clear()
+            try:
+                await self._flush()
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                logger.exception("Chat messages could not be published, retrying in %.1fs", self.retry_interval)
+                await asyncio.sleep(self.retry_interval)
+                self._wake.set()
+
+    def _payloads(self, messages: List[Tuple[str, str]]) -> List[str]:
+        payloads, batch, size = [], [], self.payload_overhead
+        for room, message in messages:
+            item = json.dumps([room, message], ensure_ascii=False)
+            item_size = len(item.encode()) + 1
+            if batch and size + item_size > self.max_payload:
+                payloads.append(f"[{next(self._sequence)},{','.join(batch)}]")
+                batch, size = [], self.payload_overhead
+            batch.append(item)
+            size += item_size
+        if batch:
+            payloads.append(f"[{next(self._sequence)},{','.join(batch)}]")
+        return payloads
+
+    def _restore(self, messages: List[Tuple[str, str]]):
+        pending = messages + self._pending
+        chat = [i for i, (room, _) in enumerate(pending) if not room.startswith(STATE_ROOM_PREFIX)]
+        if len(chat) > self.max_pending:
+            # the oldest chat messages, state messages are kept however many there are
+            dropped = set(chat[:len(chat) - self.max_pending])
+            PUBLISH_DROPPED.inc(len(dropped))
+            pending = [message for i, message in enumerate(pending) if i not in dropped]
+        self._pending = pending
+
+    async def _flush(self):
+        messages, self._pending = self._pending, []
+        if not messages:
+            return
+        PUBLISH_BATCH_SIZE.observe(len(messages))
+        try:
+            if self._publisher is None or self._publisher.is_closed():
+                self._publisher = await asyncpg.connect(self.dsn)
+            await self._publisher.execute(
+                "SELECT pg_notify($1, payload) FROM unnest($2::text[]) AS payload",
+                self.channel,
+                self._payloads(messages),
+            )
+        except BaseException:
+            # NOTIFY is transactional, none of the batch was sent
+            self._restore(messages)
+            raise
+
+
+def create_pubsub(backend: str, deliver: Deliver, dsn: str, resync: Optional[Resync] = None) -> PubSub:
+    if backend == "postgres":
+        return PostgresPubSub(deliver, dsn, resync)
+    return InMemoryPubSub(deliver, resync)
@@ -0,0 +1,183 @@
+import abc
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.db_metrics import route_path
+
+logger = logging.getLogger(__name__)
+
+REQUESTS_REJECTED = Counter(
+    "rate_limit_rejected_total",
+    "Requests rejected by admission control, by the limit they hit: client, route or concurrency",
+    ["route", "limit"],
+)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled, websockets excluded",
+                           multiprocess_mode="livesum")
+
+REDIS_TOKEN_BUCKET = """
+local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "at")
+local tokens = math.min(burst, (tonumber(bucket[1]) or burst) + (now - (tonumber(bucket[2]) or now)) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "at", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RateLimitBackend(abc.ABC):
+    """Storage of token buckets.
+
+    `take` removes `cost` tokens from the bucket of `key`, which holds at most
+    `burst` tokens and gains `rate` tokens a second. It returns 0 if the tokens
+    were there, otherwise the seconds until they will be, without taking any.
+    """
+
+    @abc.abstractmethod
+    async def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        ...
+
+    async def close(self):
+        pass
+
+
+class InMemoryBackend(RateLimitBackend):
+    """Buckets of this process, the least recently used are forgotten beyond `max_keys`"""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            # a forgotten bucket is full again, which errs on the side of admitting
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBackend(RateLimitBackend):
+    """Buckets shared by every worker and replica, updated atomically by a Lua script"""
+
+    def __init__(self, url: Optional[str] = None, prefix: str = "rate_limit:", client=None):
+        """Connects to `url`, unless a redis.asyncio `client` is given"""
+        if client is None:
+            # optional dependency, only needed when the backend is used
+            import redis.asyncio
+
+            client = redis.asyncio.from_url(url)
+        self.prefix = prefix
+        self._redis = client
+        self._script = self._redis.register_script(REDIS_TOKEN_BUCKET)
+
+    async def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        wait = await self._script(keys=[self.prefix + key], args=[rate, burst, cost, time.time()])
+        return float(wait)
+
+    async def close(self):
+        await self._redis.close()
+
+
+def create_backend(backend: str, redis_url: Optional[str] = None) -> RateLimitBackend:
+    if backend == "redis":
+        return RedisBackend(redis_url)
+    return InMemoryBackend()
+
+
+class RateLimitMiddleware:
+    """Admission control in front of the app.
+
+    A request is rejected with 429 when its client or its route is out of tokens,
+    and with 503 when `max_concurrency` requests are already being handled by
+    this worker process.
+    Clients are told when to retry in Retry-After.
+
+    A request costs the weight of its route ("POST /users/login") in the
+    client's bucket, 1 by default, and routes with a weight of 0 are not
+    limited. Routes listed in `route_rates` share a bucket of that many requests
+    a second among all clients. A rate of 0 disables the limit. If the backend
+    fails, requests are admitted.
+    """
+
+    def __init__(self, app: ASGIApp, backend: RateLimitBackend, client_rate: float, client_burst: float,
+                 weights: Dict[str, float], route_rates: Dict[str, float], max_concurrency: int,
+                 trust_forwarded: bool = False):
+        self.app = app
+        self.backend = backend
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.weights = weights
+        self.route_rates = route_rates
+        self.max_concurrency = max_concurrency
+        self.trust_forwarded = trust_forwarded
+        self.in_flight = 0
+
+    def client(self, scope: Scope) -> str:
+        if self.trust_forwarded:
+            for name, value in scope["headers"]:
+                if name == b"x-forwarded-for":
+                    return value.decode("latin-1").split(",")[0].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def _take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        try:
+            return await self.backend.take(key, cost, rate, burst)
+        except Exception:
+            logger.warning("Rate limit backend failed, admitting the request", exc_info=True)
+            return 0.0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = f"{scope['method']} {route_path(scope)}"
+        cost = self.weights.get(route, 1)
+        if cost:
+            wait = 0.0
+            route_rate = self.route_rates.get(route)
+            if route_rate:
+                # bursts of up to a second of requests, and of at least one
+                wait = await self._take(f"route:{route}", 1, route_rate, max(route_rate, 1))
+                limit = "route"
+            if not wait and self.client_rate:
+                wait = await self._take(f"client:{self.client(scope)}", cost, self.client_rate, self.client_burst)
+                limit = "client"
+            if wait:
+                REQUESTS_REJECTED.labels(route, limit).inc()
+                response = JSONResponse({"detail": "Too many requests"}, status_code=429,
+                                        headers={"Retry-After": str(math.ceil(wait))})
+                await response(scope, receive, send)
+                return
+        if self.max_concurrency and self.in_flight >= self.max_concurrency:
+            REQUESTS_REJECTED.labels(route, "concurrency").inc()
+            response = JSONResponse({"detail": "Server is overloaded"}, status_code=503, headers={"Retry-After": "1"})
+            await response(scope, receive, send)
+            return
+        self.in_flight += 1
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+            REQUESTS_IN_FLIGHT.dec()
@@ -1,5 +1,6 @@
 import datetime
 import uuid
+from typing import List
 from pydantic import BaseModel, Field, EmailStr
 from pydantic.types import Optional
 
@@ -23,3 +24,81 @@ class Friends(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class UserPublic(BaseModel):
+    id: uuid.UUID
+    name: str
+    description: str
+    age: int
+    email: str
+    login_date: Optional[datetime.datetime] = None
+
+    class Config:
+        orm_mode = True
+
+
+class UserProfile(UserPublic):
+    friend_count: int
+
+
+class UserIds(BaseModel):
+    ids: List[uuid.UUID] = Field(min_items=1)
+
+
+class UserPage(BaseModel):
+    items: List[UserPublic]
+    next_cursor: Optional[str] = None
+
+
+class UserSearchResult(UserPublic):
+    score: float
+
+
+class UserSearchPage(BaseModel):
+    items: List[UserSearchResult]
+    next_cursor: Optional[str] = None
+
+
+class FriendSuggestion(BaseModel):
+    user: UserPublic
+    mutual_friends: int
+
+
+class RowError(BaseModel):
+    line: int
+    error: str
+
+
+class BulkImportReport(BaseModel):
+    inserted: int = 0
+    failed: int = 0
+    errors: List[RowError] = []
+
+    def add_error(self, line: int, error: str, max_errors: int):
+        """Counts every failed row, but keeps details only for the first `max_errors` of them"""
+        self.failed += 1
+        if len(self.errors) < max_errors:
+            self.errors.append(RowError(line=line, error=error))
+
+
+class FriendshipImportReport(BulkImportReport):
+    # pairs already stored, or repeated in the body
+    duplicates: int = 0
+    # pairs with an unknown user
+    missing: int = 0
+
+
+class Message(BaseModel):
+    id: int
+    sender_id: uuid.UUID
+    text: str
+    created_at: datetime.datetime
+
+    class Config:
+        orm_mode = True
+
+
+class MessagePage(BaseModel):
+    items: List[Message]
+    next_cursor: Optional[str] = None
@@ -0,0 +1,183 @@
+import abc
+import asyncio
+import datetime
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+from uuid import UUID
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app import crud
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = Histogram(
+    "write_behind_flush_size",
+    "Number of entries written by one flush of a write-behind buffer",
+    ["buffer"],
+    buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000),
+)
+FLUSH_TIME = Histogram("write_behind_flush_seconds", "Duration of one flush of a write-behind buffer", ["buffer"])
+FLUSH_ERRORS = Counter("write_behind_flush_errors_total", "Failed flushes of a write-behind buffer", ["buffer"])
+DROPPED = Counter("write_behind_dropped_total", "Entries dropped because too many of them were pending", ["buffer"])
+
+
+class WriteBehindBuffer(abc.ABC):
+    """Collects writes in memory and flushes them in one batch.
+
+    A flush happens every `flush_interval` seconds, as soon as `max_size` entries
+    are pending, and on stop(). After a failed flush the batch is put back and
+    flushes are held off for a backoff that doubles up to `max_backoff` seconds.
+    Subclasses implement __len__(), _take(), _restore() and _write().
+    """
+
+    name = "buffer"
+
+    def __init__(self, flush_interval: float, max_size: int, max_backoff: float = 30.0):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_backoff = max_backoff
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._pending_flush: Optional[asyncio.Task] = None
+        self._backoff = 0.0
+        self._retry_at = 0.0
+
+    @abc.abstractmethod
+    def __len__(self):
+        ...
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def _backing_off(self) -> bool:
+        return time.monotonic() < self._retry_at
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if not self._backing_off():
+                await self.flush()
+
+    def _added(self):
+        if (len(self) >= self.max_size and not self._backing_off()
+                and (self._pending_flush is None or self._pending_flush.done())):
+            self._pending_flush = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self._lock:
+            batch = self._take()
+            if not batch:
+                return
+            with FLUSH_TIME.labels(self.name).time():
+                try:
+                    await self._write(batch)
+                except Exception:
+                    FLUSH_ERRORS.labels(self.name).inc()
+                    self._backoff = min(max(self._backoff * 2, self.flush_interval), self.max_backoff)
+                    self._retry_at = time.monotonic() + self._backoff
+                    logger.exception("Flush of %s failed, %d entries will be retried in %.1fs",
+                                     self.name, len(batch), self._backoff)
+                    self._restore(batch)
+                    return
+            self._backoff = 0.0
+            FLUSH_SIZE.labels(self.name).observe(len(batch))
+
+    @abc.abstractmethod
+    def _take(self):
+        ...
+
+    @abc.abstractmethod
+    def _restore(self, batch):
+        ...
+
+    @abc.abstractmethod
+    async def _write(self, batch):
+        ...
+
+
+class LoginDateBuffer(WriteBehindBuffer):
+    """Coalesces users' login_date updates, only the latest login of a user is written."""
+
+    name = "login_date"
+
+    def __init__(self, session_factory: async_sessionmaker, flush_interval: float, max_size: int):
+        super().__init__(flush_interval, max_size)
+        self.session_factory = session_factory
+        self._login_dates: Dict[UUID, datetime.datetime] = {}
+
+    def __len__(self):
+        return len(self._login_dates)
+
+    def add(self, user_id: UUID, login_date: Optional[datetime.datetime] = None):
+        self._login_dates[user_id] = login_date or datetime.datetime.now(datetime.timezone.utc)
+        self._added()
+
+    def _take(self):
+        batch, self._login_dates = self._login_dates, {}
+        return batch
+
+    def _restore(self, batch):
+        for user_id, login_date in batch.items():
+            self._login_dates.setdefault(user_id, login_date)
+
+    async def _write(self, batch):
+        async with self.session_factory() as db:
+            await crud.update_login_dates(db, batch)
+
+
+class MessageWriter(WriteBehindBuffer):
+    """Persists chat messages with one multi-row INSERT per flush.
+
+    Up to `max_pending` messages are kept while the database is unavailable or slow,
+    the oldest ones are dropped beyond that.
+    """
+
+    name = "messages"
+
+    def __init__(self, session_factory: async_sessionmaker, flush_interval: float, max_size: int, max_pending: int):
+        super().__init__(flush_interval, max_size)
+        self.session_factory = session_factory
+        self.max_pending = max_pending
+        self._messages: Deque[Dict] = deque(maxlen=max_pending)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, room: str, sender_id: UUID, text: str):
+        if len(self._messages) == self.max_pending:
+            DROPPED.labels(self.name).inc()
+        self._messages.append({
+            "room": room,
+            "sender_id": sender_id,
+            "text": text,
+            "created_at": datetime.datetime.now(datetime.timezone.utc),
+        })
+        self._added()
+
+    def _take(self):
+        batch, self._messages = list(self._messages), deque(maxlen=self.max_pending)
+        return batch
+
+    def _restore(self, batch):
+        messages = batch + list(self._messages)
+        DROPPED.labels(self.name).inc(max(len(messages) - self.max_pending, 0))
+        self._messages = deque(messages[-self.max_pending:], maxlen=self.max_pending)
+
+    async def _write(self, batch):
+        async with self.session_factory() as db:
+            await crud.create_messages(db, batch)
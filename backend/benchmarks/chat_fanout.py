@@ -0,0 +1,75 @@
+"""Fan-out latency of a chat room with many connected websockets.
+
+Websockets are stand-ins that take --send-delay to send a message, a share of them
+(--slow) never finish sending, as clients that stopped reading. Latency is measured
+from broadcast() until the message was sent to every fast client.
+
+    python -m benchmarks.chat_fanout --connections 10000 --messages 100
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from app.connection_manager import DISCONNECT, DROP_OLDEST, ConnectionManager
+
+
+class StubWebSocket:
+    def __init__(self, send_delay: float, stalled: bool, delivered: dict):
+        self.send_delay = send_delay
+        self.stalled = stalled
+        self.delivered = delivered
+
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, message: str):
+        if self.stalled:
+            await asyncio.Event().wait()
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.delivered[message] = self.delivered.get(message, 0) + 1
+
+
+async def run(connections: int, messages: int, slow: float, send_delay: float, policy: str, queue_size: int):
+    manager = ConnectionManager(queue_size=queue_size, policy=policy)
+    delivered = {}
+    stalled = int(connections * slow)
+    for i in range(connections):
+        await manager.connect(StubWebSocket(send_delay, i < stalled, delivered), "room")
+    fast = connections - stalled
+    latencies = []
+    for i in range(messages):
+        message = f"message {i}"
+        start = time.perf_counter()
+        manager.broadcast("room", message)
+        while delivered.get(message, 0) < fast:
+            await asyncio.sleep(0)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print(f"connections: {connections} ({stalled} stalled), policy: {policy}")
+    print(f"fan-out latency: p50 {statistics.median(latencies) * 1000:.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} ms, "
+          f"max {latencies[-1] * 1000:.2f} ms")
+    print(f"connections left: {sum(len(room) for room in manager.rooms.values())}")
+    for connection in list(manager.rooms.get("room", ())):
+        manager.disconnect(connection)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--slow", type=float, default=0.01, help="share of clients that stop reading")
+    parser.add_argument("--send-delay", type=float, default=0.0, help="seconds one send takes")
+    parser.add_argument("--policy", choices=[DROP_OLDEST, DISCONNECT], default=DROP_OLDEST)
+    parser.add_argument("--queue-size", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(run(args.connections, args.messages, args.slow, args.send_delay, args.policy, args.queue_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Deep-page latency of keyset pagination against OFFSET.
+
+Run from the backend directory against a populated database (see data_generator.py):
+
+    python -m benchmarks.pagination --depth 0 10000 100000 1000000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from sqlalchemy import select
+
+from app import crud, models
+from app.database import async_session, engine
+
+
+async def timed(db, query, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        (await db.execute(query)).all()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+async def run(depths, limit: int, repeat: int):
+    print(f"{'depth':>10} {'offset, ms':>12} {'keyset, ms':>12}")
+    async with async_session() as db:
+        for depth in depths:
+            offset_query = select(*crud.PUBLIC_USER_COLUMNS).order_by(models.User.id).offset(depth).limit(limit)
+            after = None
+            if depth:
+                after = (await db.execute(select(models.User.id).order_by(models.User.id).offset(depth - 1).limit(1)))
+                after = after.scalar_one_or_none()
+                if after is None:
+                    print(f"{depth:>10} table has fewer rows, skipped")
+                    continue
+            keyset_query = select(*crud.PUBLIC_USER_COLUMNS).order_by(models.User.id).limit(limit)
+            if after is not None:
+                keyset_query = keyset_query.where(models.User.id > after)
+            offset_ms = await timed(db, offset_query, repeat)
+            keyset_ms = await timed(db, keyset_query, repeat)
+            print(f"{depth:>10} {offset_ms:>12.2f} {keyset_ms:>12.2f}")
+    await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, nargs="+", default=[0, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.depth, args.limit, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
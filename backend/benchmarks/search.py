@@ -0,0 +1,55 @@
+"""Latency of user search and name autocomplete.
+
+Run from the backend directory against a populated database (see data_generator.py):
+
+    python -m benchmarks.search --query maria "coffee table" --prefix m ma mar --pages 3
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from app import crud
+from app.database import async_session, engine
+
+
+async def timed(db, run, repeat: int):
+    timings, rows = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = (await run(db)).all()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000, rows
+
+
+async def run(args):
+    async with async_session() as db:
+        print(f"{'search':>30} {'page':>5} {'rows':>5} {'ms':>8}")
+        for query in args.query:
+            after = None
+            for page in range(args.pages):
+                ms, rows = await timed(db, lambda db: crud.search_users(db, query, after=after, limit=args.limit),
+                                       args.repeat)
+                print(f"{query:>30} {page:>5} {len(rows):>5} {ms:>8.2f}")
+                if len(rows) < args.limit:
+                    break
+                after = (rows[-1].score, rows[-1].id)
+        print(f"\n{'autocomplete':>30} {'rows':>11} {'ms':>8}")
+        for prefix in args.prefix:
+            ms, rows = await timed(db, lambda db: crud.autocomplete_users(db, prefix, limit=10), args.repeat)
+            print(f"{prefix:>30} {len(rows):>11} {ms:>8.2f}")
+    await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--query", nargs="+", default=["maria", "james", "coffee table", "zzzqqq"])
+    parser.add_argument("--prefix", nargs="+", default=["m", "ma", "mar", "zz"])
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
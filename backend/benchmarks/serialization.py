@@ -0,0 +1,72 @@
+"""Serialization cost of user lists, by response path.
+
+Needs no database, rows are built in memory:
+
+    python -m benchmarks.serialization --rows 100 10000
+"""
+import argparse
+import datetime
+import statistics
+import time
+import uuid
+from collections import namedtuple
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from app import crud, models, schemas
+
+# same fields as the rows of crud.get_users
+PublicUser = namedtuple("PublicUser", [column.key for column in crud.PUBLIC_USER_COLUMNS])
+
+
+def make_users(count: int):
+    login_date = datetime.datetime(2024, 1, 1)
+    return [
+        models.User(id=uuid.uuid4(), name=f"User{i}", description="Benchmark user", age=30,
+                    email=f"user{i}@bench.test", password="$2b$12$" + "x" * 53, login_date=login_date)
+        for i in range(count)
+    ]
+
+
+def orm_jsonable(users):
+    # what a handler returning ORM objects without a response model costs
+    return JSONResponse(jsonable_encoder(users))
+
+
+def pydantic_models(users):
+    return JSONResponse(jsonable_encoder([schemas.UserPublic.from_orm(user) for user in users]))
+
+
+def rows_orjson(rows):
+    return ORJSONResponse([row._asdict() for row in rows])
+
+
+def timed(function, argument, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(argument)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def run(sizes, repeat: int):
+    print(f"{'rows':>10} {'orm + jsonable, ms':>20} {'pydantic, ms':>14} {'rows + orjson, ms':>19}")
+    for size in sizes:
+        users = make_users(size)
+        rows = [PublicUser(*(getattr(user, field) for field in PublicUser._fields)) for user in users]
+        print(f"{size:>10} {timed(orm_jsonable, users, repeat):>20.2f} {timed(pydantic_models, users, repeat):>14.2f} "
+              f"{timed(rows_orjson, rows, repeat):>19.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 10_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Production server: gunicorn -c gunicorn.conf.py app.main:app
+
+The app is imported once by the master and forked into WEB_CONCURRENCY uvicorn
+workers. On SIGTERM workers stop accepting connections and get GRACEFUL_TIMEOUT
+seconds to finish requests and flush write-behind buffers.
+
+Every worker has its own pools, principal cache and friend graph. Chat messages,
+new friendships and cache invalidations reach the other workers through
+Postgres LISTEN/NOTIFY, so several workers need CHAT_PUBSUB_BACKEND=postgres,
+otherwise a single worker is started. Prometheus metrics are written by every
+process to PROMETHEUS_MULTIPROC_DIR, and /metrics aggregates them.
+"""
+import multiprocessing
+import os
+
+# must be set before prometheus_client is imported, here or by the app
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+MULTIPROC_DIR = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import multiprocess  # noqa: E402
+
+from app.core.config import settings  # noqa: E402
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+# with the in-memory pub/sub, workers would not see each other's friendships, cache invalidations and chats
+workers = int(os.environ.get("WEB_CONCURRENCY",
+                             multiprocessing.cpu_count() if settings.CHAT_PUBSUB_BACKEND == "postgres" else 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.environ.get("WORKER_TIMEOUT", "60"))
+keepalive = 5
+accesslog = "-"
+
+
+def on_starting(server):
+    # metrics of a previous run would be added to this one's. Not done when the config is loaded,
+    # which --check-config does too. The preloaded app has written files by now, workers write their own
+    for name in os.listdir(MULTIPROC_DIR):
+        os.remove(os.path.join(MULTIPROC_DIR, name))
+
+
+def child_exit(server, worker):
+    # live gauges of the worker, like connections in use, are no longer reported
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,3 +1,4 @@
+import json
 from uuid import UUID
 import requests
 from app.main import password_context
@@ -5,10 +6,27 @@ from app.main import password_context
 URL = "http://0.0.0.0:5000"
 
 
+def create_users(prefix, count):
+    """Registers `count` users with emails prefix_0@mail.ru, prefix_1@mail.ru, ..., returns their ids"""
+    return [
+        requests.post(
+            f"{URL}/users/",
+            json={
+                "name": f"{prefix.capitalize()}{i}",
+                "age": 20 + i,
+                "description": "Created by a test",
+                "email": f"{prefix}_{i}@mail.ru",
+                "password": prefix,
+            },
+        ).json()
+        for i in range(count)
+    ]
+
+
 def test_get_empty_users():
     response = requests.get(f"{URL}/users/")
     assert response.status_code == 200
-    assert response.json() == []
+    assert response.json() == {"items": [], "next_cursor": None}
 
 
 def test_get_users():
@@ -34,15 +52,32 @@ def test_get_users():
     ]
     response = requests.get(f"{URL}/users/")
     assert response.status_code == 200
-    new_users = response.json()
+    new_users = {user["id"]: user for user in response.json()["items"]}
     assert len(new_users) == len(users)
-    for i, new_user in enumerate(new_users):
-        assert new_user["id"] == ids[i]
+    for i, id in enumerate(ids):
+        new_user = new_users[id]
         assert new_user["name"] == users[i]["name"]
         assert new_user["age"] == users[i]["age"]
         assert new_user["description"] == users[i]["description"]
         assert new_user["email"] == users[i]["email"]
-        assert new_user["password"] != users[i]["password"]
+        assert "password" not in new_user
+
+
+def test_get_users_by_pages():
+    all_users = requests.get(f"{URL}/users/", params={"limit": 1000}).json()["items"]
+    paged_users = []
+    response = requests.get(f"{URL}/users/", params={"limit": 1}).json()
+    while response["next_cursor"]:
+        assert len(response["items"]) == 1
+        paged_users += response["items"]
+        response = requests.get(f"{URL}/users/", params={"limit": 1, "cursor": response["next_cursor"]}).json()
+    paged_users += response["items"]
+    assert [user["id"] for user in paged_users] == [user["id"] for user in all_users]
+
+
+def test_get_users_invalid_cursor():
+    response = requests.get(f"{URL}/users/", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
 
 
 def test_hashing_passwords():
@@ -91,6 +126,7 @@ def test_get_user_by_id():
     assert new_user["age"] == user2["age"]
     assert new_user["description"] == user2["description"]
     assert new_user["email"] == user2["email"]
+    assert "password" not in new_user
 
 
 def test_update_user():
@@ -116,7 +152,47 @@ def test_update_user():
     assert response.json() == updated_user
     response_get_updated_user = requests.get(f"{URL}/users/{id}")
     assert response_get_updated_user.status_code == 200
-    assert response_get_updated_user.json() == updated_user
+    del updated_user["password"]
+    assert response_get_updated_user.json() == {**updated_user, "friend_count": 0}
+
+
+def test_update_user_with_registered_email():
+    user = {
+        "name": "Ivan",
+        "age": 22,
+        "description": "I like travelling",
+        "email": "taken_by_first@gmail.com",
+        "password": "123",
+    }
+    requests.post(f"{URL}/users/", json=user)
+    user["email"] = "taken_by_second@gmail.com"
+    user["id"] = requests.post(f"{URL}/users/", json=user).json()
+    user["email"] = "Taken_By_First@gmail.com"
+    response = requests.put(f"{URL}/users/{user['id']}", json=user)
+    assert response.status_code == 400
+    assert requests.get(f"{URL}/users/{user['id']}").json()["email"] == "taken_by_second@gmail.com"
+
+
+def test_get_user_not_modified():
+    user = {
+        "name": "Oleg",
+        "age": 31,
+        "description": "Reads the same profile twice",
+        "email": "oleg.etag@example.com",
+        "password": "etag",
+    }
+    id = requests.post(f"{URL}/users/", json=user).json()
+    response = requests.get(f"{URL}/users/{id}")
+    etag = response.headers["ETag"]
+    response = requests.get(f"{URL}/users/{id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    user["description"] = "Changed"
+    requests.put(f"{URL}/users/{id}", json={**user, "id": id})
+    response = requests.get(f"{URL}/users/{id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["description"] == "Changed"
+    assert response.headers["ETag"] != etag
 
 
 def test_create_user():
@@ -134,6 +210,35 @@ def test_create_user():
     assert UUID(response.json(), version=4) is not None
 
 
+def test_create_user_with_registered_email():
+    user = {
+        "name": "Ivan",
+        "age": 22,
+        "description": "I like travelling",
+        "email": "ivan_twice@gmail.com",
+        "password": "123",
+    }
+    response = requests.post(f"{URL}/users/", json=user)
+    assert response.status_code == 200
+    user["email"] = "Ivan_Twice@gmail.com"
+    response = requests.post(f"{URL}/users/", json=user)
+    assert response.status_code == 400
+
+
+def test_create_user_with_taken_id():
+    user = {
+        "name": "Ivan",
+        "age": 22,
+        "description": "I like travelling",
+        "email": "ivan_first@gmail.com",
+        "password": "123",
+    }
+    user["id"] = requests.post(f"{URL}/users/", json=user).json()
+    user["email"] = "ivan_second@gmail.com"
+    response = requests.post(f"{URL}/users/", json=user)
+    assert response.status_code == 409
+
+
 def test_create_friendship():
     user1 = {
         "name": "Kate",
@@ -166,5 +271,128 @@ def test_create_friendship():
     )
     assert response.status_code == 200
     response = response.json()
-    assert response["friend_id_one"] == id1
-    assert response["friend_id_two"] == id2
+    assert [response["friend_id_one"], response["friend_id_two"]] == sorted([id1, id2])
+    response = requests.post(f"{URL}/users/friends/", json={"id_friend_one": id2, "id_friend_two": id1})
+    assert response.status_code == 200
+    assert requests.get(f"{URL}/users/{id1}").json()["friend_count"] == 1
+    assert requests.get(f"{URL}/users/{id2}").json()["friend_count"] == 1
+
+
+def test_get_users_batch():
+    ids = create_users("batch", 3)
+    unknown = "00000000-0000-4000-8000-000000000000"
+    response = requests.post(f"{URL}/users/batch", json={"ids": [ids[2], unknown, ids[0], ids[2]]})
+    assert response.status_code == 200
+    users = response.json()
+    assert [user["id"] for user in users] == [ids[2], ids[0]]
+    assert all("password" not in user for user in users)
+
+
+def test_mutual_friends_and_suggestions():
+    ids = create_users("friend", 3)
+    for id_one, id_two in [(ids[0], ids[1]), (ids[1], ids[2])]:
+        response = requests.post(f"{URL}/users/friends/", json={"id_friend_one": id_one, "id_friend_two": id_two})
+        assert response.status_code == 200
+    response = requests.get(f"{URL}/get_friends/", params={"user_id": ids[1]})
+    assert response.status_code == 200
+    assert sorted(user["id"] for user in response.json()) == sorted([ids[0], ids[2]])
+    response = requests.get(f"{URL}/users/{ids[0]}/friends/mutual", params={"other_id": ids[2]})
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json()] == [ids[1]]
+    # answered from the database until the friend graph is loaded
+    response = requests.get(f"{URL}/users/{ids[0]}/friends/suggestions")
+    assert response.status_code == 200
+    assert [(s["user"]["id"], s["mutual_friends"]) for s in response.json()] == [(ids[2], 1)]
+
+
+def test_bulk_create_users():
+    rows = [
+        '{"name": "Bulk", "age": 30, "description": "Imported", "email": "bulk_1@mail.ru", "password": "bulk"}',
+        '{"name": "Bulk", "age": 30, "description": "Imported", "email": "BULK_1@mail.ru", "password": "bulk"}',
+        '{"name": "Bulk", "age": -1, "description": "Imported", "email": "bulk_2@mail.ru", "password": "bulk"}',
+        "not json",
+    ]
+    response = requests.post(
+        f"{URL}/users/bulk", headers={"Content-Type": "application/x-ndjson"}, data="\n".join(rows)
+    )
+    assert response.status_code == 200
+    report = response.json()
+    assert report["inserted"] == 1
+    assert report["failed"] == 3
+    assert sorted(error["line"] for error in report["errors"]) == [2, 3, 4]
+    assert {"line": 2, "error": "Email repeats line 1"} in report["errors"]
+
+    csv_body = "name,description,age,email,password\nBulk,Imported,31,bulk_3@mail.ru,bulk\n"
+    response = requests.post(f"{URL}/users/bulk", headers={"Content-Type": "text/csv"}, data=csv_body)
+    assert response.status_code == 200
+    assert response.json() == {"inserted": 1, "failed": 0, "errors": []}
+
+
+def test_bulk_create_friendships():
+    ids = create_users("graph", 3)
+    unknown = "00000000-0000-4000-8000-000000000000"
+    rows = [
+        {"id_friend_one": ids[0], "id_friend_two": ids[1]},
+        {"id_friend_one": ids[1], "id_friend_two": ids[0]},
+        {"id_friend_one": ids[1], "id_friend_two": ids[2]},
+        {"id_friend_one": ids[0], "id_friend_two": unknown},
+        {"id_friend_one": ids[0], "id_friend_two": ids[0]},
+    ]
+    response = requests.post(
+        f"{URL}/users/friends/bulk", headers={"Content-Type": "application/x-ndjson"},
+        data="\n".join(json.dumps(row) for row in rows),
+    )
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["inserted"], report["duplicates"], report["missing"], report["failed"]) == (2, 1, 1, 1)
+    assert [error["line"] for error in report["errors"]] == [5]
+    assert requests.get(f"{URL}/users/{ids[1]}").json()["friend_count"] == 2
+
+
+def test_export_users():
+    user = {
+        "name": "Export",
+        "age": 50,
+        "description": "Dumped",
+        "email": "export@mail.ru",
+        "password": "export",
+    }
+    id = requests.post(f"{URL}/users/", json=user).json()
+    response = requests.get(f"{URL}/users/export", params={"chunk_size": 2}, stream=True)
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    users = [json.loads(line) for line in response.iter_lines() if line]
+    assert id in [user["id"] for user in users]
+    assert all("password" not in user for user in users)
+
+    requests.post(f"{URL}/users/login", data={"username": user["email"], "password": user["password"]})
+    response = requests.get(f"{URL}/users/export", params={"format": "csv", "login_from": "2100-01-01T00:00:00Z"})
+    assert response.status_code == 200
+    assert response.text.splitlines() == ["id,name,description,age,email,login_date"]
+
+
+def test_search_users():
+    for i, (name, description) in enumerate([
+        ("Svetlana", "Plays the violin"),
+        ("Svetlana", "Collects stamps"),
+        ("Boris", "Friend of Svetlana"),
+        ("Sveta", "Likes violins"),
+    ]):
+        requests.post(f"{URL}/users/", json={
+            "name": name, "age": 25, "description": description, "email": f"search_{i}@mail.ru", "password": "search",
+        })
+    response = requests.get(f"{URL}/users/search", params={"q": "svetlana", "limit": 2})
+    assert response.status_code == 200
+    page = response.json()
+    assert [user["name"] for user in page["items"]] == ["Svetlana", "Svetlana"]
+    response = requests.get(f"{URL}/users/search", params={"q": "svetlana", "limit": 2, "cursor": page["next_cursor"]})
+    assert response.status_code == 200
+    # a description match ranks below name matches
+    assert "Boris" in [user["name"] for user in response.json()["items"]]
+    response = requests.get(f"{URL}/users/search", params={"q": "svetlana", "cursor": "not a cursor"})
+    assert response.status_code == 400
+
+    response = requests.get(f"{URL}/users/autocomplete", params={"prefix": "SVET"})
+    assert response.status_code == 200
+    names = [user["name"] for user in response.json()]
+    assert names[:3] == ["Sveta", "Svetlana", "Svetlana"]
@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+from app import bulk_import
+from app.bulk_import import import_users
+
+
+class PlainHasher:
+    """Stands in for the password hasher, without the cost of hashing"""
+
+    async def hash_many(self, passwords):
+        return [f"hashed {password}" for password in passwords]
+
+
+async def body(rows):
+    yield "\n".join(json.dumps(row) for row in rows).encode()
+
+
+def test_rows_repeated_within_a_chunk_are_reported(monkeypatch):
+    copied = []
+
+    async def copy_users(db, users):
+        copied.extend(users)
+        return {user.id for user in users}
+
+    monkeypatch.setattr(bulk_import.crud, "copy_users", copy_users)
+    user = {"name": "Bulk", "age": 30, "description": "Imported", "password": "bulk"}
+    rows = [
+        dict(user, id="00000000-0000-4000-8000-000000000001", email="one@mail.ru"),
+        dict(user, id="00000000-0000-4000-8000-000000000001", email="two@mail.ru"),
+        dict(user, id="00000000-0000-4000-8000-000000000002", email="ONE@mail.ru"),
+        dict(user, id="00000000-0000-4000-8000-000000000003", email="three@mail.ru"),
+    ]
+    report = asyncio.run(import_users(None, body(rows), "ndjson", PlainHasher(), chunk_size=10, max_errors=10))
+    assert [user.email for user in copied] == ["one@mail.ru", "three@mail.ru"]
+    assert report.inserted == 2
+    assert [(error.line, error.error) for error in report.errors] == [
+        (2, "Id repeats line 1"), (3, "Email repeats line 1"),
+    ]
@@ -0,0 +1,46 @@
+from prometheus_client import REGISTRY
+
+from app import cache
+from app.cache import TTLCache
+
+
+def counted(name, cache_name):
+    return REGISTRY.get_sample_value(name, {"cache": cache_name}) or 0
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now)
+    principals = TTLCache("test_expiry", maxsize=10, ttl=5)
+    principals.set("a", 1)
+    now += 4
+    assert principals.get("a") == 1
+    now += 2
+    assert principals.get("a") is None
+    assert len(principals) == 0
+    assert counted("cache_hits_total", "test_expiry") == 1
+    assert counted("cache_misses_total", "test_expiry") == 1
+
+
+def test_least_recently_used_is_evicted():
+    principals = TTLCache("test_lru", maxsize=2, ttl=60)
+    principals.set("a", 1)
+    principals.set("b", 2)
+    assert principals.get("a") == 1
+    principals.set("c", 3)
+    assert principals.get("b") is None
+    assert principals.get("a") == 1
+    assert principals.get("c") == 3
+    assert counted("cache_evictions_total", "test_lru") == 1
+
+
+def test_invalidate_and_clear():
+    principals = TTLCache("test_invalidate", maxsize=10, ttl=60)
+    principals.set("a", 1)
+    principals.set("b", 2)
+    principals.invalidate("a")
+    principals.invalidate("missing")
+    assert principals.get("a") is None
+    assert principals.get("b") == 2
+    principals.clear()
+    assert len(principals) == 0
@@ -0,0 +1,73 @@
+import asyncio
+
+from prometheus_client import REGISTRY
+from starlette import status
+
+from app.connection_manager import DISCONNECT, DROP_OLDEST, ConnectionManager
+
+
+class SlowWebSocket:
+    """Stands in for a client that reads nothing until `reading` is set"""
+
+    def __init__(self):
+        self.reading = asyncio.Event()
+        self.received = []
+        self.close_code = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        await self.reading.wait()
+        self.received.append(message)
+
+    async def close(self, code):
+        self.close_code = code
+
+
+def counted(name):
+    return REGISTRY.get_sample_value(name) or 0
+
+
+def test_drop_oldest_keeps_latest_messages():
+    async def run():
+        chat = ConnectionManager(queue_size=2, policy=DROP_OLDEST)
+        websocket = SlowWebSocket()
+        await chat.connect(websocket, "lobby")
+        for message in ("1", "2", "3", "4"):
+            chat.broadcast("lobby", message)
+        websocket.reading.set()
+        await asyncio.sleep(0.01)
+        assert len(chat.rooms["lobby"]) == 1
+        return websocket
+
+    before = counted("chat_dropped_messages_total")
+    websocket = asyncio.run(run())
+    assert websocket.received == ["3", "4"]
+    assert websocket.close_code is None
+    assert counted("chat_dropped_messages_total") == before + 2
+
+
+def test_disconnect_closes_slow_client():
+    async def run():
+        chat = ConnectionManager(queue_size=2, policy=DISCONNECT)
+        slow, fast = SlowWebSocket(), SlowWebSocket()
+        fast.reading.set()
+        await chat.connect(slow, "lobby")
+        await chat.connect(fast, "lobby")
+        # the slow client holds "1" and queues "2" and "3", "4" does not fit
+        for message in ("1", "2", "3", "4"):
+            chat.broadcast("lobby", message)
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+        assert [connection.websocket for connection in chat.rooms["lobby"]] == [fast]
+        assert counted("chat_connections") == connected + 1
+        assert not chat._drops
+        return slow, fast
+
+    before = counted("chat_slow_consumers_disconnected_total")
+    connected = counted("chat_connections")
+    slow, fast = asyncio.run(run())
+    assert slow.close_code == status.WS_1013_TRY_AGAIN_LATER
+    assert fast.received == ["1", "2", "3", "4"]
+    assert counted("chat_slow_consumers_disconnected_total") == before + 1
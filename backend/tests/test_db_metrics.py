@@ -0,0 +1,30 @@
+import pytest
+
+from app.db_metrics import fingerprint
+
+
+@pytest.mark.parametrize("statement, expected", [
+    ("SELECT users.id FROM users WHERE users.id = $1::UUID", "SELECT users.id FROM users WHERE users.id = ?"),
+    ("SELECT *\n  FROM users\n WHERE age > 30 AND name = 'O''Brien'", "SELECT * FROM users WHERE age > ? AND name = ?"),
+    ("SELECT * FROM users WHERE id IN ($1::UUID, $2::UUID, $3::UUID)", "SELECT * FROM users WHERE id IN (...)"),
+    ("SELECT * FROM users WHERE id = ANY($1::UUID[])", "SELECT * FROM users WHERE id = ANY(?)"),
+    ("SELECT * FROM users WHERE created_at < $1::TIMESTAMP WITH TIME ZONE LIMIT $2::INTEGER",
+     "SELECT * FROM users WHERE created_at < ? LIMIT ?"),
+    ("INSERT INTO messages (room, text) VALUES ($1, $2), ($3, $4), ($5, $6)",
+     "INSERT INTO messages (room, text) VALUES (...)"),
+    ("SELECT * FROM users WHERE id = %(id)s", "SELECT * FROM users WHERE id = ?"),
+    # digits within names are kept
+    ("SELECT 1.5, users2.id FROM users2", "SELECT ?, users2.id FROM users2"),
+])
+def test_fingerprint(statement, expected):
+    assert fingerprint(statement) == expected
+
+
+def test_fingerprints_of_calls_with_different_literals_match():
+    assert fingerprint("SELECT * FROM users LIMIT 10 OFFSET 20") == fingerprint("SELECT * FROM users LIMIT 5 OFFSET 0")
+    assert fingerprint("SELECT * FROM users WHERE id IN ($1, $2)") == \
+        fingerprint("SELECT * FROM users WHERE id IN ($1, $2, $3, $4)")
+
+
+def test_fingerprint_is_truncated():
+    assert len(fingerprint("SELECT " + "name, " * 100 + "id FROM users")) == 200
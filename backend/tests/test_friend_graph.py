@@ -0,0 +1,135 @@
+import asyncio
+from uuid import UUID
+
+import pytest
+
+from app.friend_graph import FriendGraph, GraphNotReady
+
+
+def user(n):
+    return UUID(int=n)
+
+
+class FriendshipTable:
+    """Stands in for a session factory of a database with the given friendships.
+
+    Streaming waits for `streaming` to be set after the first partition, streams fail
+    while `failures` is positive.
+    """
+
+    def __init__(self, friendships, partition_size=2):
+        self.friendships = [(user(one), user(two)) for one, two in friendships]
+        self.partition_size = partition_size
+        self.streaming = asyncio.Event()
+        self.streaming.set()
+        self.failures = 0
+
+    def __call__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def stream(self, statement):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("connection refused")
+        return self
+
+    async def partitions(self):
+        for start in range(0, len(self.friendships), self.partition_size):
+            yield self.friendships[start:start + self.partition_size]
+            await self.streaming.wait()
+
+
+def test_load():
+    graph = FriendGraph(max_users=100, max_friendships=100)
+    with pytest.raises(GraphNotReady):
+        graph.friends(user(1))
+    asyncio.run(graph.load(FriendshipTable([(1, 2), (1, 3), (2, 3), (3, 4)])))
+    assert sorted(graph.friends(user(3))) == [user(1), user(2), user(4)]
+    assert graph.mutual_friends(user(1), user(4)) == [user(3)]
+    assert graph.friends(user(5)) == []
+
+
+def test_load_over_budget_disables_graph():
+    graph = FriendGraph(max_users=100, max_friendships=2)
+    asyncio.run(graph.load(FriendshipTable([(1, 2), (1, 3), (2, 3), (3, 4)])))
+    assert not graph.ready
+    with pytest.raises(GraphNotReady):
+        graph.suggestions(user(1), 10)
+
+
+def test_edges_added_after_load():
+    graph = FriendGraph(max_users=100, max_friendships=100)
+    asyncio.run(graph.load(FriendshipTable([(1, 2)])))
+    graph.add_edge(user(2), user(3))
+    graph.add_edge(user(3), user(2))
+    assert sorted(graph.friends(user(2))) == [user(1), user(3)]
+    assert graph._overlay_edges == 1
+    assert graph.suggestions(user(1), 10) == [(user(3), 1)]
+
+
+def test_edges_added_while_loading():
+    table = FriendshipTable([(1, 2), (2, 3)], partition_size=1)
+    graph = FriendGraph(max_users=100, max_friendships=100)
+
+    async def run():
+        table.streaming.clear()
+        loading = asyncio.create_task(graph.load(table))
+        await asyncio.sleep(0)
+        graph.add_edge(user(3), user(4))
+        assert not graph.ready
+        table.streaming.set()
+        await loading
+
+    asyncio.run(run())
+    assert sorted(graph.friends(user(3))) == [user(2), user(4)]
+
+
+def test_suggestions_ranked_by_mutual_friends():
+    # 1 shares friends 2 and 3 with 5, and only 2 with 4
+    table = FriendshipTable([(1, 2), (1, 3), (2, 4), (2, 5), (3, 5), (3, 6)])
+    graph = FriendGraph(max_users=100, max_friendships=100)
+    asyncio.run(graph.load(table))
+    assert graph.suggestions(user(1), 10)[0] == (user(5), 2)
+    assert sorted(graph.suggestions(user(1), 10)[1:]) == [(user(4), 1), (user(6), 1)]
+    assert len(graph.suggestions(user(1), 2)) == 2
+    assert graph.suggestions(user(7), 10) == []
+
+
+def test_overlay_is_compacted():
+    graph = FriendGraph(max_users=100, max_friendships=100, compact_after=2)
+
+    async def run():
+        await graph.load(FriendshipTable([(1, 2)]))
+        graph.add_edge(user(2), user(3))
+        graph.add_edge(user(3), user(4))
+        await asyncio.sleep(0)
+        # added while compacting, stays in the overlay
+        graph.add_edge(user(4), user(5))
+        await graph._compaction
+
+    asyncio.run(run())
+    assert graph._overlay_edges == 1
+    assert sorted(graph.friends(user(3))) == [user(2), user(4)]
+    assert sorted(graph.friends(user(4))) == [user(3), user(5)]
+    assert graph.suggestions(user(2), 10) == [(user(4), 1)]
+
+
+def test_failed_load_is_retried():
+    table = FriendshipTable([(1, 2)])
+    table.failures = 1
+    graph = FriendGraph(max_users=100, max_friendships=100)
+
+    async def run():
+        graph.start(table, max_backoff=0.01)
+        while not graph.ready:
+            await asyncio.sleep(0.01)
+        await graph.stop()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert graph.friends(user(1)) == [user(2)]
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app import hashing
+from app.hashing import PasswordHasher, PasswordPoolSaturated
+
+
+def sample(name, operation):
+    return REGISTRY.get_sample_value(name, {"operation": operation}) or 0
+
+
+def slow_run(delay, running, peak):
+    lock = threading.Lock()
+
+    def run(operation, *args):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        started_at = time.monotonic()
+        time.sleep(delay)
+        with lock:
+            running[0] -= 1
+        return f"hashed {args[0]}", started_at, time.monotonic() - started_at
+
+    return run
+
+
+def test_saturated_pool_fails_fast(monkeypatch):
+    monkeypatch.setattr(hashing, "_run", slow_run(0.1, [0], [0]))
+    hasher = PasswordHasher(workers=1, max_queue=0, fail_fast=True)
+    rejected = sample("password_hash_rejected_total", "hash")
+
+    async def run():
+        first = asyncio.create_task(hasher.hash("one"))
+        await asyncio.sleep(0.01)
+        with pytest.raises(PasswordPoolSaturated):
+            await hasher.hash("two")
+        return await first
+
+    try:
+        assert asyncio.run(run()) == "hashed one"
+    finally:
+        hasher.shutdown()
+    assert sample("password_hash_rejected_total", "hash") == rejected + 1
+
+
+def test_operations_are_timed():
+    hasher = PasswordHasher(workers=1)
+    hashed = sample("password_hash_duration_seconds_count", "hash")
+    verified = sample("password_hash_queue_wait_seconds_count", "verify")
+
+    async def run():
+        password = await hasher.hash("secret")
+        return await hasher.verify("secret", password), await hasher.verify("wrong", password)
+
+    try:
+        assert asyncio.run(run()) == (True, False)
+    finally:
+        hasher.shutdown()
+    assert sample("password_hash_duration_seconds_count", "hash") == hashed + 1
+    assert sample("password_hash_queue_wait_seconds_count", "verify") == verified + 2
+
+
+def test_hash_many_leaves_a_worker_free(monkeypatch):
+    running, peak = [0], [0]
+    monkeypatch.setattr(hashing, "_run", slow_run(0.02, running, peak))
+    hasher = PasswordHasher(workers=3, fail_fast=True)
+    try:
+        hashed = asyncio.run(hasher.hash_many([str(i) for i in range(8)]))
+    finally:
+        hasher.shutdown()
+    assert hashed == [f"hashed {i}" for i in range(8)]
+    assert peak[0] == 2
@@ -0,0 +1,83 @@
+import asyncio
+from collections import namedtuple
+from uuid import UUID
+
+import pytest
+
+from app.loaders import UserLoader
+
+UserRow = namedtuple("UserRow", "id name")
+
+
+class UsersResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+
+class CountingSession:
+    """Stands in for a session of a database with the users of the given ids, records the ids of every query"""
+
+    def __init__(self, user_ids, error=None):
+        self.users = {user_id: UserRow(user_id, f"user {user_id.int}") for user_id in user_ids}
+        self.error = error
+        self.queries = []
+
+    async def execute(self, statement):
+        user_ids = statement.compile().params["ids"]
+        self.queries.append(user_ids)
+        if self.error:
+            raise self.error
+        return UsersResult([self.users[user_id] for user_id in user_ids if user_id in self.users])
+
+
+def user(n):
+    return UUID(int=n)
+
+
+def test_loads_are_coalesced_into_one_query():
+    db = CountingSession([user(1), user(2), user(3)])
+    loader = UserLoader(db)
+
+    async def run():
+        return await asyncio.gather(
+            loader.load(user(2)), loader.load_many([user(1), user(2)]), loader.load(user(4)),
+        )
+
+    two, many, missing = asyncio.run(run())
+    # one query, with every id once
+    [user_ids] = db.queries
+    assert sorted(user_ids) == [user(1), user(2), user(4)]
+    assert two.name == "user 2"
+    assert [row.name for row in many] == ["user 1", "user 2"]
+    assert missing is None
+
+
+def test_users_are_loaded_once_per_loader():
+    db = CountingSession([user(1), user(2)])
+    loader = UserLoader(db)
+
+    async def run():
+        first = await loader.load(user(1))
+        rows = await loader.load_many([user(1), user(2)])
+        return first, rows
+
+    first, rows = asyncio.run(run())
+    assert db.queries == [[user(1)], [user(2)]]
+    assert rows[0] is first
+
+
+def test_failed_query_is_retried_by_a_later_load():
+    db = CountingSession([user(1)], error=OSError("connection reset"))
+    loader = UserLoader(db)
+
+    async def run():
+        with pytest.raises(OSError):
+            await loader.load(user(1))
+        db.error = None
+        return await loader.load(user(1))
+
+    assert asyncio.run(run()).id == user(1)
+    assert db.queries == [[user(1)], [user(1)]]
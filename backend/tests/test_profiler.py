@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from starlette.applications import Starlette
+from starlette.routing import Route
+
+from app.profiler import ProfilerMiddleware, StackSampler
+
+
+def spin(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+async def busy_handler():
+    for _ in range(10):
+        spin(0.02)
+        await asyncio.sleep(0)
+
+
+def frame(function):
+    return f"{function.__name__} (test_profiler.py:{function.__code__.co_firstlineno})"
+
+
+def test_sampler_records_frames_of_busy_coroutine():
+    sampler = StackSampler(interval=0.001, max_stacks=100)
+
+    async def run():
+        profile = sampler.begin()
+        await busy_handler()
+        profile.root = "GET /busy"
+        sampler.end(profile, keep=True)
+
+    asyncio.run(run())
+    lines = sampler.collapsed().splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    frames = stack.split(";")
+    assert frames[0] == "GET /busy"
+    assert frames[-2:] == [frame(busy_handler), frame(spin)]
+    assert int(count) > 0
+    # the sampling thread stops with the last profile
+    spin(0.01)
+    assert sampler._thread is None
+
+
+def test_middleware_keeps_only_slow_requests():
+    sampler = StackSampler(interval=0.001, max_stacks=100)
+
+    async def app(scope, receive, send):
+        if scope["path"] == "/slow":
+            await busy_handler()
+
+    middleware = ProfilerMiddleware(app, sampler, sample_rate=1.0, threshold=0.1)
+    # only consulted for the route path of the profile
+    routes = Starlette(routes=[Route(path, app) for path in ("/fast", "/slow")])
+
+    async def run():
+        for path in ("/fast", "/slow"):
+            scope = {"type": "http", "method": "GET", "path": path, "headers": [], "app": routes}
+            await middleware(scope, None, None)
+
+    asyncio.run(run())
+    roots = {line.split(";", 1)[0] for line in sampler.collapsed().splitlines()}
+    assert roots == {"GET /slow"}
+    sampler.reset()
+    assert sampler.collapsed() == ""
@@ -0,0 +1,91 @@
+import asyncio
+import json
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.pubsub import MessageTooLarge, PostgresPubSub
+
+
+class FailingConnection:
+    """Stands in for a publisher connection to a database that is down"""
+
+    def is_closed(self):
+        return False
+
+    async def execute(self, *args):
+        raise OSError("connection refused")
+
+
+def postgres_pubsub(**options):
+    delivered = []
+    pubsub = PostgresPubSub(lambda room, message: delivered.append((room, message)), dsn="unused", **options)
+    return pubsub, delivered
+
+
+def test_payloads_are_chunked_and_unique():
+    pubsub, delivered = postgres_pubsub(max_payload=200)
+    messages = [("lobby", "x" * 50)] * 10
+    payloads = pubsub._payloads(messages)
+    assert len(payloads) > 1
+    assert all(len(payload.encode()) <= 200 for payload in payloads)
+    # Postgres would deliver identical payloads of one transaction once
+    assert len(set(payloads)) == len(payloads)
+    for payload in payloads:
+        pubsub._on_notify(None, 0, pubsub.channel, payload)
+    assert delivered == messages
+
+
+def test_message_too_large():
+    pubsub, _ = postgres_pubsub(max_payload=200)
+    asyncio.run(pubsub.publish("lobby", "x" * 160))
+    with pytest.raises(MessageTooLarge):
+        asyncio.run(pubsub.publish("lobby", "x" * 180))
+    [payload] = pubsub._payloads(pubsub._pending)
+    assert len(payload.encode()) <= 200
+    assert json.loads(payload)[1:] == [["lobby", "x" * 160]]
+
+
+def test_failed_flush_keeps_latest_messages():
+    pubsub, _ = postgres_pubsub(max_pending=3)
+    pubsub._publisher = FailingConnection()
+    before = REGISTRY.get_sample_value("chat_pubsub_dropped_messages_total") or 0
+    for i in range(2):
+        asyncio.run(pubsub.publish("lobby", str(i)))
+    with pytest.raises(OSError):
+        asyncio.run(pubsub._flush())
+    for i in range(2, 4):
+        asyncio.run(pubsub.publish("lobby", str(i)))
+    with pytest.raises(OSError):
+        asyncio.run(pubsub._flush())
+    assert pubsub._pending == [("lobby", "1"), ("lobby", "2"), ("lobby", "3")]
+    assert REGISTRY.get_sample_value("chat_pubsub_dropped_messages_total") == before + 1
+
+
+def test_failed_flush_keeps_every_state_message():
+    pubsub, _ = postgres_pubsub(max_pending=2)
+    pubsub._publisher = FailingConnection()
+    before = REGISTRY.get_sample_value("chat_pubsub_dropped_messages_total") or 0
+    for i in range(3):
+        asyncio.run(pubsub.publish("$friendships", str(i)))
+        asyncio.run(pubsub.publish("lobby", str(i)))
+    with pytest.raises(OSError):
+        asyncio.run(pubsub._flush())
+    assert pubsub._pending == [
+        ("$friendships", "0"), ("$friendships", "1"), ("lobby", "1"), ("$friendships", "2"), ("lobby", "2"),
+    ]
+    assert REGISTRY.get_sample_value("chat_pubsub_dropped_messages_total") == before + 1
+
+
+def test_reconnected_listener_resyncs():
+    resyncs = []
+    pubsub, _ = postgres_pubsub(resync=lambda: resyncs.append(len(listens)))
+    listens = []
+
+    async def listen():
+        listens.append(True)
+
+    pubsub._listen = listen
+    asyncio.run(pubsub._reconnect())
+    # after listening again, so that nothing published since is missed
+    assert resyncs == [1]
@@ -0,0 +1,66 @@
+import asyncio
+import json
+from uuid import UUID
+
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from app import crud, models
+from app.database import engine
+
+EMAIL_INDEX = "ix_users_email_lower"
+
+
+def explain(query):
+    # the dialect of the engine, psycopg2's would double the % of LIKE and trigram operators
+    sql = query.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True})
+
+    async def run():
+        async with engine.connect() as conn:
+            # tables in tests are small, the planner would prefer a sequential scan otherwise
+            await conn.execute(text("SET enable_seqscan = off"))
+            plan = await conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"))
+            plan = plan.scalar_one()
+        await engine.dispose()
+        return plan if isinstance(plan, list) else json.loads(plan)
+
+    return asyncio.run(run())[0]["Plan"]
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def test_email_lookup_uses_index():
+    plan = explain(select(*crud.PUBLIC_USER_COLUMNS).where(crud.email_matches("Masha@ya.ru")))
+    assert any(node.get("Index Name") == EMAIL_INDEX for node in plan_nodes(plan))
+
+
+def test_create_user_conflict_uses_index():
+    plan = explain(insert(models.User).values(
+        id="7c8a3a46-6f60-4f0e-a0a2-3e6b2a0c1d11", name="Masha", description="-", age=23, email="masha@ya.ru",
+        password="-"
+    ).on_conflict_do_nothing(index_elements=[func.lower(models.User.email)]))
+    assert EMAIL_INDEX in plan["Conflict Arbiter Indexes"]
+
+
+def test_find_friendship_is_one_probe():
+    plan = explain(crud.friendship_query(UUID("7c8a3a46-6f60-4f0e-a0a2-3e6b2a0c1d11"),
+                                         UUID("1d0e4b27-9a3c-4d5e-8f60-7a8b9c0d1e2f")))
+    assert plan["Node Type"] in ("Index Scan", "Index Only Scan")
+    assert plan["Index Name"] == "friendship_pkey"
+
+
+def test_search_uses_trigram_indexes():
+    plan = explain(crud.search_users_query("ivan"))
+    indexes = {node.get("Index Name") for node in plan_nodes(plan)}
+    assert {"ix_users_name_trgm", "ix_users_description_trgm"} <= indexes
+
+
+def test_autocomplete_scans_prefix_in_order():
+    plan = explain(crud.autocomplete_query("Iva"))
+    nodes = list(plan_nodes(plan))
+    assert any(node.get("Index Name") == "ix_users_name_prefix" for node in nodes)
+    assert not any(node["Node Type"] == "Sort" for node in nodes)
@@ -0,0 +1,88 @@
+import asyncio
+
+import httpx
+from fakeredis import aioredis
+from prometheus_client import REGISTRY
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from app import rate_limit
+from app.rate_limit import InMemoryBackend, RateLimitMiddleware, RedisBackend
+
+
+def limited_app(handler=None, **options):
+    async def ok(request):
+        if handler:
+            await handler()
+        return PlainTextResponse("ok")
+
+    limits = dict(backend=InMemoryBackend(), client_rate=0.001, client_burst=10, max_concurrency=0,
+                  weights={"POST /login": 5, "GET /free": 0}, route_rates={})
+    limits.update(options)
+    return Starlette(routes=[Route("/cheap", ok), Route("/login", ok, methods=["POST"]), Route("/free", ok)],
+                     middleware=[Middleware(RateLimitMiddleware, **limits)])
+
+
+def rejected(route, limit):
+    return REGISTRY.get_sample_value("rate_limit_rejected_total", {"route": route, "limit": limit}) or 0
+
+
+def send(app, *requests):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await asyncio.gather(*(client.request(method, path) for method, path in requests))
+
+    return asyncio.run(run())
+
+
+def test_client_bucket_counts_route_weights():
+    app = limited_app()
+    before = rejected("POST /login", "client")
+    responses = send(app, ("POST", "/login"), ("POST", "/login"), ("POST", "/login"))
+    assert [response.status_code for response in responses] == [200, 200, 429]
+    assert int(responses[2].headers["Retry-After"]) > 0
+    assert rejected("POST /login", "client") == before + 1
+    # the bucket is empty, but free routes are not limited
+    assert send(app, ("GET", "/free"))[0].status_code == 200
+
+
+def test_route_bucket_is_shared_by_clients():
+    app = limited_app(client_rate=0, route_rates={"GET /cheap": 0.001})
+    responses = send(app, ("GET", "/cheap"), ("GET", "/cheap"))
+    assert [response.status_code for response in responses] == [200, 429]
+
+
+def test_concurrency_limit_sheds_load():
+    async def slow():
+        await asyncio.sleep(0.1)
+
+    app = limited_app(slow, client_rate=0, max_concurrency=2)
+    responses = send(app, *[("GET", "/cheap")] * 3)
+    assert sorted(response.status_code for response in responses) == [200, 200, 503]
+    assert REGISTRY.get_sample_value("http_requests_in_flight") == 0
+
+
+def test_redis_backend_script(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(rate_limit.time, "time", lambda: now)
+    # fakeredis runs the Lua script
+    backend = RedisBackend(client=aioredis.FakeRedis())
+
+    async def take(cost):
+        return await backend.take("client:1", cost, rate=2, burst=4)
+
+    async def run():
+        nonlocal now
+        waits = [await take(3), await take(3)]
+        now += 1
+        waits.append(await take(3))
+        ttl = await backend._redis.ttl("rate_limit:client:1")
+        await backend.close()
+        return waits, ttl
+
+    waits, ttl = asyncio.run(run())
+    # 1 of 4 tokens is left after the first request, the second needs (3 - 1) / 2 seconds more
+    assert waits == [0, 1.0, 0]
+    assert 0 < ttl <= 3
@@ -0,0 +1,69 @@
+import asyncio
+from uuid import uuid4
+
+from prometheus_client import REGISTRY
+
+from app.write_behind import MessageWriter
+
+
+class FailingSession:
+    """Stands in for a session of a database that is down"""
+
+    async def __aenter__(self):
+        raise OSError("connection refused")
+
+    async def __aexit__(self, *args):
+        pass
+
+
+def dropped_messages():
+    return REGISTRY.get_sample_value("write_behind_dropped_total", {"buffer": "messages"}) or 0
+
+
+def test_message_writer_keeps_latest_pending_messages():
+    writer = MessageWriter(FailingSession, flush_interval=60, max_size=100, max_pending=3)
+    sender_id = uuid4()
+    failures = REGISTRY.get_sample_value("write_behind_flush_errors_total", {"buffer": "messages"}) or 0
+    dropped = dropped_messages()
+
+    async def run():
+        for text in ("1", "2"):
+            writer.add("lobby", sender_id, text)
+        await writer.flush()
+        for text in ("3", "4"):
+            writer.add("lobby", sender_id, text)
+        await writer.flush()
+
+    asyncio.run(run())
+    assert [message["text"] for message in writer._messages] == ["2", "3", "4"]
+    assert REGISTRY.get_sample_value("write_behind_flush_errors_total", {"buffer": "messages"}) == failures + 2
+    assert dropped_messages() == dropped + 1
+
+
+def test_message_writer_bounds_added_messages():
+    # no flush is due, as if the database were slow
+    writer = MessageWriter(FailingSession, flush_interval=60, max_size=100, max_pending=3)
+    sender_id = uuid4()
+    dropped = dropped_messages()
+    for text in ("1", "2", "3", "4", "5"):
+        writer.add("lobby", sender_id, text)
+    assert [message["text"] for message in writer._messages] == ["3", "4", "5"]
+    assert dropped_messages() == dropped + 2
+
+
+def test_failed_flush_backs_off():
+    writer = MessageWriter(FailingSession, flush_interval=0.5, max_size=2, max_pending=100)
+    sender_id = uuid4()
+
+    async def run():
+        for text in ("1", "2"):
+            writer.add("lobby", sender_id, text)
+        await writer._pending_flush
+        flush = writer._pending_flush
+        # still above max_size, but no flush is started while backing off
+        writer.add("lobby", sender_id, "3")
+        assert writer._pending_flush is flush
+        assert writer._backoff == 0.5
+
+    asyncio.run(run())
+    assert len(writer) == 3
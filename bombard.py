@@ -1,37 +1,333 @@
+"""Load generator for the API.
+
+    python bombard.py mix --rate 200 --duration 60 --mix create=1,login=1,get=5,list=2,friends=2,befriend=1,chat=1
+    python bombard.py replay traffic.jsonl --speed 2
+
+Requests are started on schedule (open loop), whether or not the previous ones
+have finished, and latency is counted from the scheduled start, so a stalled
+server shows up as latency instead of as a lower request rate.
+
+`mix` picks scenarios at random with the given weights, the users it creates
+are reused by the other scenarios. `replay` sends requests from a JSON lines
+file, one request per line:
+
+    {"at": 0.5, "method": "POST", "path": "/users/", "json": {...}}
+
+with optional "data", "headers" and "name" (the endpoint it is reported under).
+
+Latency percentiles of every endpoint are printed as JSON, or written to --output.
+All requests come from one address, so the server under test should run with
+RATE_LIMIT_ENABLED=false, the default, or most of them are answered with 429.
+"""
+import argparse
+import asyncio
+import json
+import math
 import random
+import re
+import string
+import sys
+import time
+from collections import Counter, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import httpx
+import websockets
+
+UUID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+class Histogram:
+    """Log-linear histogram of latencies in microseconds, like HdrHistogram.
+
+    Every power of two is split into 2 ** precision_bits buckets, so recorded
+    values are kept with a relative error below 2 ** -precision_bits.
+    """
+
+    def __init__(self, precision_bits: int = 7):
+        self.sub_buckets = 2 ** precision_bits
+        self.counts: Counter = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _bucket(self, value: float) -> Tuple[int, int]:
+        if value < 1:
+            return 0, 0
+        exponent = int(math.log2(value))
+        return exponent, int((value / 2 ** exponent - 1) * self.sub_buckets)
+
+    def _value(self, bucket: Tuple[int, int]) -> float:
+        exponent, sub_bucket = bucket
+        return 2 ** exponent * (1 + (sub_bucket + 0.5) / self.sub_buckets)
+
+    def record(self, value: float):
+        self.counts[self._bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self._value(bucket), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "p50": self.percentile(50) / 1000,
+            "p90": self.percentile(90) / 1000,
+            "p99": self.percentile(99) / 1000,
+            "p99.9": self.percentile(99.9) / 1000,
+            "max": self.max / 1000,
+            "mean": self.total / self.count / 1000 if self.count else 0.0,
+        }
+
+
+class Stats:
+    def __init__(self):
+        self.latency: Dict[str, Histogram] = {}
+        self.statuses: Dict[str, Counter] = {}
+        self.errors: Counter = Counter()
+        # exceptions raised by the scenarios themselves
+        self.client_errors: Counter = Counter()
+        self.skipped = 0
+
+    def record(self, endpoint: str, scheduled_at: float, status: str):
+        self.latency.setdefault(endpoint, Histogram()).record((time.perf_counter() - scheduled_at) * 1_000_000)
+        self.statuses.setdefault(endpoint, Counter())[status] += 1
+
+    def report(self) -> Dict:
+        return {
+            "endpoints": {
+                endpoint: {
+                    "count": histogram.count,
+                    "statuses": dict(self.statuses[endpoint]),
+                    "errors": self.errors[endpoint],
+                    "latency_ms": histogram.summary(),
+                }
+                for endpoint, histogram in sorted(self.latency.items())
+            },
+            "client_errors": dict(self.client_errors),
+            "skipped": self.skipped,
+        }
+
+
+class Context:
+    """Client and users shared by the scenarios"""
+
+    def __init__(self, client: httpx.AsyncClient, ws_url: str, stats: Stats, timeout: float):
+        self.client = client
+        self.ws_url = ws_url
+        # seconds to wait for a websocket echo, HTTP requests use the timeout of the client
+        self.timeout = timeout
+        self.stats = stats
+        self.users: Deque[Tuple[str, str, str]] = deque(maxlen=10_000)
+
+    async def request(self, endpoint: str, scheduled_at: float, method: str, path: str, **kwargs) -> httpx.Response:
+        try:
+            response = await self.client.request(method, path, **kwargs)
+        except httpx.HTTPError as e:
+            self.stats.errors[endpoint] += 1
+            self.stats.record(endpoint, scheduled_at, type(e).__name__)
+            raise
+        self.stats.record(endpoint, scheduled_at, str(response.status_code))
+        return response
+
+    def random_user(self) -> Optional[Tuple[str, str, str]]:
+        return random.choice(self.users) if self.users else None
+
+
+def random_word(length: int = 8) -> str:
+    return "".join(random.choices(string.ascii_lowercase, k=length))
 
-import requests
-from faker import Faker
 
-ENDPOINT = "http://localhost:5000/user/{}"
-ENDPOINT2 = "http://localhost:5000/users"
-ENDPOINT3 = "http://localhost:5000/users1"
+async def create(ctx: Context, scheduled_at: float):
+    email, password = f"{random_word(12)}@load.test", random_word()
+    response = await ctx.request("POST /users/", scheduled_at, "POST", "/users/", json={
+        "name": random_word().title(),
+        "description": random_word(20),
+        "age": random.randint(18, 80),
+        "email": email,
+        "password": password,
+    })
+    if response.status_code == 200:
+        ctx.users.append((response.json(), email, password))
 
 
-POST_ENDPOINT = ""
+async def login(ctx: Context, scheduled_at: float):
+    user = ctx.random_user()
+    if user:
+        await ctx.request("POST /users/login", scheduled_at, "POST", "/users/login",
+                          data={"username": user[1], "password": user[2]})
 
 
-def main():
-    f = Faker()
-    while True:
-        rand = random.randint(0, 4)
-        if rand == 0:
-            _ = requests.get(ENDPOINT.format(random.randint(0, 100)))
-        elif rand == 1:
-            _ = requests.get(ENDPOINT2)
-        elif rand == 2:
-            _ = requests.get(ENDPOINT3)
-        # elif rand == 3:
-        #     _ = requests.exceptions.HTTPError
+async def get(ctx: Context, scheduled_at: float):
+    user = ctx.random_user()
+    if user:
+        await ctx.request("GET /users/{user_id}", scheduled_at, "GET", f"/users/{user[0]}")
+
+
+async def list_users(ctx: Context, scheduled_at: float):
+    await ctx.request("GET /users/", scheduled_at, "GET", "/users/", params={"limit": 100})
+
+
+async def friends(ctx: Context, scheduled_at: float):
+    user = ctx.random_user()
+    if user:
+        await ctx.request("GET /get_friends/", scheduled_at, "GET", "/get_friends/", params={"user_id": user[0]})
+
+
+async def befriend(ctx: Context, scheduled_at: float):
+    if len(ctx.users) >= 2:
+        one, two = random.sample(ctx.users, 2)
+        await ctx.request("POST /users/friends/", scheduled_at, "POST", "/users/friends/",
+                          json={"id_friend_one": one[0], "id_friend_two": two[0]})
+
+
+async def echo(websocket, message: str):
+    # other clients' messages may come first
+    while not (await websocket.recv()).endswith(message):
+        pass
+
+
+async def chat(ctx: Context, scheduled_at: float):
+    endpoint = "WS /ws/{client_id}"
+    message = random_word()
+    try:
+        async with websockets.connect(f"{ctx.ws_url}/ws/{random.randint(1, 10 ** 9)}") as websocket:
+            await websocket.send(message)
+            await asyncio.wait_for(echo(websocket, message), ctx.timeout)
+    except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+        ctx.stats.errors[endpoint] += 1
+        ctx.stats.record(endpoint, scheduled_at, type(e).__name__)
+        return
+    ctx.stats.record(endpoint, scheduled_at, "ok")
+
+
+SCENARIOS: Dict[str, Callable[[Context, float], Awaitable[None]]] = {
+    "create": create,
+    "login": login,
+    "get": get,
+    "list": list_users,
+    "friends": friends,
+    "befriend": befriend,
+    "chat": chat,
+}
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name}, choose from {', '.join(SCENARIOS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+async def run_schedule(schedule, ctx: Context, max_in_flight: int):
+    """Starts every (offset, coroutine function) of the schedule at its offset from now"""
+    in_flight = set()
+    started_at = time.perf_counter()
+    for offset, action in schedule:
+        scheduled_at = started_at + offset
+        delay = scheduled_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(in_flight) >= max_in_flight:
+            ctx.stats.skipped += 1
+            continue
+        task = asyncio.create_task(guarded(action, ctx, scheduled_at))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    if in_flight:
+        await asyncio.wait(in_flight)
+
+
+async def guarded(action, ctx: Context, scheduled_at: float):
+    try:
+        await action(ctx, scheduled_at)
+    except httpx.HTTPError:
+        # already counted by Context.request
+        pass
+    except Exception as e:
+        ctx.stats.client_errors[f"{action.__name__}: {type(e).__name__}"] += 1
+
+
+def mix_schedule(weights: Dict[str, float], rate: float, duration: float):
+    names, values = list(weights), list(weights.values())
+    for i in range(int(rate * duration)):
+        yield i / rate, SCENARIOS[random.choices(names, values)[0]]
+
+
+def replay_schedule(path: str, speed: float):
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            endpoint = entry.get("name") or f"{entry['method']} {UUID_RE.sub('{id}', entry['path'])}"
+
+            async def send(ctx: Context, scheduled_at: float, entry=entry, endpoint=endpoint):
+                await ctx.request(endpoint, scheduled_at, entry["method"], entry["path"], json=entry.get("json"),
+                                  data=entry.get("data"), headers=entry.get("headers"))
+
+            yield entry.get("at", 0) / speed, send
+
+
+async def main(args):
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        ctx = Context(client, re.sub(r"^http", "ws", args.url), stats, args.timeout)
+        if args.command == "mix":
+            # users for the other scenarios, not measured
+            for _ in range(args.seed_users):
+                await guarded(create, ctx, time.perf_counter())
+            ctx.stats = stats = Stats()
+            schedule = mix_schedule(args.mix, args.rate, args.duration)
         else:
-            payload = {
-                "name": f.name(),
-                "age": random.randint(18,60),
-                "description": f.text(),
-                "email": f.email(),
-                "password": f.password(),
-            }
-            _ = requests.post(ENDPOINT2, json=payload)
+            schedule = replay_schedule(args.file, args.speed)
+        started_at = time.time()
+        await run_schedule(schedule, ctx, args.max_in_flight)
+    report = {"started_at": started_at, "duration": time.time() - started_at, "command": args.command}
+    if args.command == "mix":
+        report.update(rate=args.rate, mix=args.mix)
+    report.update(stats.report())
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+def parse_args(argv: List[str]):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--connections", type=int, default=100, help="HTTP connection pool size")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--max-in-flight", type=int, default=10_000,
+                        help="requests due while this many are in flight are skipped and counted")
+    parser.add_argument("--output", help="file for the JSON report")
+    commands = parser.add_subparsers(dest="command", required=True)
+    mix = commands.add_parser("mix", help="random requests at a constant rate")
+    mix.add_argument("--rate", type=float, default=100, help="requests per second")
+    mix.add_argument("--duration", type=float, default=60, help="seconds")
+    mix.add_argument("--mix", type=parse_mix, default="create=1,login=1,get=5,list=2,friends=2,befriend=1,chat=1",
+                     help="scenario=weight pairs, scenarios: " + ", ".join(SCENARIOS))
+    mix.add_argument("--seed-users", type=int, default=20, help="users created before the run")
+    replay = commands.add_parser("replay", help="requests from a JSON lines file")
+    replay.add_argument("file")
+    replay.add_argument("--speed", type=float, default=1, help="speed up factor")
+    return parser.parse_args(argv)
 
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main(parse_args(sys.argv[1:])))